@@ -0,0 +1,293 @@
+#!/usr/bin/env /usr/bin/python3
+
+import os
+import sys
+import warnings
+import threading
+import importlib.util
+import numpy as np
+
+# numba takes a while to import, it is only loaded once a kernel is compiled
+numba_available = importlib.util.find_spec('numba') is not None
+
+################################################################################
+# selection of the kernel implementation #
+##########################################
+
+# the environment variable ND2_KERNELS=numpy|numba|auto forces either path
+backend = 'numpy'
+
+def set_backend (name = 'auto'):
+	global backend
+	if name == 'auto':
+		name = 'numba' if numba_available else 'numpy'
+	if name not in ('numpy', 'numba'):
+		raise ValueError('Unknown kernel backend: {0:s}'.format(name))
+	if name == 'numba' and not numba_available:
+		raise ImportError('Numba is not installed.')
+	backend = name
+
+def get_backend ():
+	return backend
+
+# the numba kernels are checked against the numpy kernels the first time
+# they are used. the first caller runs the check while the other threads
+# wait, so numpy takes over before any numba kernel ran if they differ
+numba_checked = False
+numba_lock = threading.Lock()
+
+def use_numba ():
+	global backend, numba_checked
+	if backend == 'numba' and not numba_checked:
+		with numba_lock:
+			if not numba_checked:
+				if not check_equivalence():
+					warnings.warn('The numba kernels differ from numpy, '
+								  'using numpy instead.')
+					backend = 'numpy'
+				numba_checked = True
+	return backend == 'numba'
+
+################################################################################
+# numpy kernels #
+#################
+
+def lineseg_dists(p, a, b):
+	# Handle case where p is a single point, i.e. 1d array.
+	p = np.atleast_2d(p)
+	if np.all(a == b):
+		return np.linalg.norm(p - a, axis=1)
+	# normalized tangent vector
+	d = np.divide(b - a, np.linalg.norm(b - a))
+	# signed parallel distance components
+	s = np.dot(a - p, d)
+	t = np.dot(p - b, d)
+	# clamped parallel distance
+	h = np.maximum.reduce([s, t, np.zeros(len(p))])
+	# perpendicular distance component, the 2D cross product written out
+	c = (p[:,0] - a[0])*d[1] - (p[:,1] - a[1])*d[0]
+	# use hypot for Pythagoras to improve accuracy
+	return np.hypot(h, c)
+
+def nearest_segments_numpy (points, starts, ends):
+	min_distance = np.full(points.shape[0], np.inf)
+	min_index = np.zeros(points.shape[0], dtype = np.int64)
+	for index in range(starts.shape[0]):
+		distances = lineseg_dists(points, starts[index], ends[index])
+		closer = (distances < min_distance)
+		min_distance[closer] = distances[closer]
+		min_index[closer] = index
+	return min_distance, min_index
+
+def link_layers_numpy (positions_layer, minimum_distance):
+	# positions are sorted by layer, a nucleus is followed from its first
+	# layer through every next layer with a close enough centre
+	count = positions_layer.shape[0]
+	layers = positions_layer[:,2]
+	alive = np.ones(count, dtype = bool)
+	members = []
+	offsets = [0]
+	for seed in range(count):
+		if not alive[seed]:
+			continue
+		alive[seed] = False
+		x_0, y_0, z_0 = positions_layer[seed]
+		chain = 0
+		while True:
+			start = np.searchsorted(layers, z_0+1, side = 'left')
+			stop = np.searchsorted(layers, z_0+1, side = 'right')
+			candidates = start + np.flatnonzero(alive[start:stop])
+			if len(candidates) == 0:
+				break
+			distances = np.linalg.norm(positions_layer[candidates,:2] - \
+										np.array([x_0,y_0]), axis=1)
+			local_index = np.argmin(distances)
+			if distances[local_index] >= minimum_distance:
+				break
+			index = candidates[local_index]
+			alive[index] = False
+			members.append(index)
+			chain += 1
+			x_0 = (x_0 * chain + positions_layer[index,0]) / (chain+1)
+			y_0 = (y_0 * chain + positions_layer[index,1]) / (chain+1)
+			z_0 = layers[index]
+		offsets.append(len(members))
+	return np.array(members, dtype = np.int64), \
+		   np.array(offsets, dtype = np.int64)
+
+def window_medians_numpy (image, centres, delta):
+	medians = np.full(centres.shape[0], np.nan)
+	for index,(c_x,c_y) in enumerate(centres):
+		window = image[c_y-delta:c_y+delta, c_x-delta:c_x+delta]
+		if window.size > 0:
+			medians[index] = np.median(window)
+	return medians
+
+################################################################################
+# numba kernels #
+#################
+
+compiled = {}
+
+def jit (function):
+	if function.__name__ not in compiled:
+		import numba
+		compiled[function.__name__] = numba.njit(cache = True)(function)
+	return compiled[function.__name__]
+
+def nearest_segments_numba (points, starts, ends):
+	min_distance = np.full(points.shape[0], np.inf)
+	min_index = np.zeros(points.shape[0], dtype = np.int64)
+	for index in range(starts.shape[0]):
+		a_x, a_y = starts[index,0], starts[index,1]
+		b_x, b_y = ends[index,0], ends[index,1]
+		length = np.sqrt((b_x - a_x)**2 + (b_y - a_y)**2)
+		for point in range(points.shape[0]):
+			p_x, p_y = points[point,0], points[point,1]
+			if length == 0.:
+				distance = np.sqrt((p_x - a_x)**2 + (p_y - a_y)**2)
+			else:
+				d_x = (b_x - a_x) / length
+				d_y = (b_y - a_y) / length
+				s = (a_x - p_x) * d_x + (a_y - p_y) * d_y
+				t = (p_x - b_x) * d_x + (p_y - b_y) * d_y
+				h = max(s, t, 0.)
+				c = (p_x - a_x) * d_y - (p_y - a_y) * d_x
+				distance = np.hypot(h, c)
+			if distance < min_distance[point]:
+				min_distance[point] = distance
+				min_index[point] = index
+	return min_distance, min_index
+
+def link_layers_numba (positions_layer, minimum_distance):
+	count = positions_layer.shape[0]
+	layers = positions_layer[:,2].copy()
+	alive = np.ones(count, dtype = np.bool_)
+	members = np.empty(count, dtype = np.int64)
+	offsets = np.zeros(count+1, dtype = np.int64)
+	member_count = 0
+	group_count = 0
+	for seed in range(count):
+		if not alive[seed]:
+			continue
+		alive[seed] = False
+		x_0 = positions_layer[seed,0]
+		y_0 = positions_layer[seed,1]
+		z_0 = positions_layer[seed,2]
+		chain = 0
+		while True:
+			best_index = -1
+			best_distance = np.inf
+			index = np.searchsorted(layers, z_0+1)
+			while index < count and layers[index] == z_0+1:
+				if alive[index]:
+					distance = np.sqrt(
+							(positions_layer[index,0] - x_0)**2 + \
+							(positions_layer[index,1] - y_0)**2)
+					if distance < best_distance:
+						best_distance = distance
+						best_index = index
+				index += 1
+			if best_index < 0 or best_distance >= minimum_distance:
+				break
+			alive[best_index] = False
+			members[member_count] = best_index
+			member_count += 1
+			chain += 1
+			x_0 = (x_0 * chain + positions_layer[best_index,0]) / (chain+1)
+			y_0 = (y_0 * chain + positions_layer[best_index,1]) / (chain+1)
+			z_0 = layers[best_index]
+		group_count += 1
+		offsets[group_count] = member_count
+	return members[:member_count], offsets[:group_count+1]
+
+def window_medians_numba (image, centres, delta):
+	medians = np.full(centres.shape[0], np.nan)
+	for index in range(centres.shape[0]):
+		c_x = centres[index,0]
+		c_y = centres[index,1]
+		window = image[c_y-delta:c_y+delta, c_x-delta:c_x+delta]
+		if window.size > 0:
+			medians[index] = np.median(window.copy())
+	return medians
+
+################################################################################
+# dispatching functions #
+#########################
+
+def nearest_segments_compiled (points, starts, ends):
+	return jit(nearest_segments_numba)(
+				np.ascontiguousarray(points, dtype = np.float64),
+				np.ascontiguousarray(starts, dtype = np.float64),
+				np.ascontiguousarray(ends, dtype = np.float64))
+
+def link_layers_compiled (positions_layer, minimum_distance):
+	return jit(link_layers_numba)(
+				np.ascontiguousarray(positions_layer, dtype = np.float64),
+				float(minimum_distance))
+
+def window_medians_compiled (image, centres, delta):
+	return jit(window_medians_numba)(np.asarray(image),
+				np.ascontiguousarray(centres, dtype = np.int64),
+				int(delta))
+
+def nearest_segments (points, starts, ends):
+	if points.shape[1] == 2 and use_numba():
+		return nearest_segments_compiled(points, starts, ends)
+	return nearest_segments_numpy(points, starts, ends)
+
+def link_layers (positions_layer, minimum_distance):
+	if use_numba():
+		return link_layers_compiled(positions_layer, minimum_distance)
+	return link_layers_numpy(positions_layer, minimum_distance)
+
+def window_medians (image, centres, delta):
+	if use_numba():
+		return window_medians_compiled(image, centres, delta)
+	return window_medians_numpy(image, centres, delta)
+
+set_backend(os.environ.get('ND2_KERNELS', 'auto'))
+
+################################################################################
+# equivalence check of the two implementations #
+################################################
+
+def check_equivalence (seed = 0):
+	if not numba_available:
+		raise ImportError('Numba is not installed.')
+	rng = np.random.default_rng(seed)
+	points = rng.random((500,2)) * 100
+	starts = rng.random((50,2)) * 100
+	ends = starts + rng.random((50,2)) * 10
+	ends[0] = starts[0]
+	layers = np.sort(rng.integers(0, 20, 3000))
+	positions_layer = np.column_stack([rng.random((3000,2)) * 200, layers])
+	image = rng.random((256,256)) * 4095
+	centres = rng.integers(-5, 260, (400,2))
+	# the implementations are called directly, the backend stays as it is
+	results = {}
+	results['numpy'] = (nearest_segments_numpy(points, starts, ends),
+						link_layers_numpy(positions_layer, 4),
+						window_medians_numpy(image, centres, 9))
+	results['numba'] = (nearest_segments_compiled(points, starts, ends),
+						link_layers_compiled(positions_layer, 4),
+						window_medians_compiled(image, centres, 9))
+	(distance_np, index_np), (members_np, offsets_np), medians_np = \
+															results['numpy']
+	(distance_nb, index_nb), (members_nb, offsets_nb), medians_nb = \
+															results['numba']
+	return np.allclose(distance_np, distance_nb) and \
+		   np.all(index_np == index_nb) and \
+		   np.array_equal(members_np, members_nb) and \
+		   np.array_equal(offsets_np, offsets_nb) and \
+		   np.allclose(medians_np, medians_nb, equal_nan = True)
+
+if __name__ == "__main__":
+	if check_equivalence():
+		print('numpy and numba kernels agree')
+		sys.exit(0)
+	print('numpy and numba kernels differ')
+	sys.exit(1)
+
+################################################################################
+# EOF
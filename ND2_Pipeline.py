@@ -0,0 +1,1949 @@
+#!/usr/bin/env /usr/bin/python3
+
+import os
+import time
+import queue
+import json
+import hashlib
+import shutil
+import threading
+import struct
+import zipfile
+import tempfile
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from ND2_Kernels import link_layers, window_medians
+
+# the processing without the window, it does not import Qt or matplotlib so
+# that the watcher, the server and the query tool run without them. scipy,
+# trimesh, mahotas and nd2reader are imported where they are first used
+
+################################################################################
+# content addressed cache of results #
+######################################
+
+def cache_directory (name):
+	root = os.environ.get('ND2PLOTTER_CACHE',
+						  str(Path.home() / '.cache' / 'ND2Plotter'))
+	return Path(root) / name
+
+def partial_path (path):
+	# each writer gets its own temporary file, moved over the final one
+	# with os.replace once written
+	path = Path(path)
+	path.parent.mkdir(parents = True, exist_ok = True)
+	handle, partial = tempfile.mkstemp(dir = str(path.parent),
+									   prefix = path.stem + '.',
+									   suffix = '.partial' + path.suffix)
+	os.close(handle)
+	return Path(partial)
+
+def file_fingerprint (file_path, header_size = 1 << 20):
+	file_stat = Path(file_path).stat()
+	with open(str(file_path), 'rb') as file:
+		header = hashlib.sha256(file.read(header_size)).hexdigest()
+	return {'size': file_stat.st_size,
+			'mtime': file_stat.st_mtime_ns,
+			'header': header}
+
+def run_key (fingerprint, roi, parameters):
+	text = json.dumps({'file': fingerprint,
+					   'roi': [int(value) for value in roi],
+					   'parameters': parameters}, sort_keys = True)
+	return hashlib.sha256(text.encode()).hexdigest()
+
+class ResultCache ():
+	def __init__ (self, directory = None, max_size = 2 << 30):
+		if directory is None:
+			directory = cache_directory('results')
+		self.directory = Path(directory)
+		self.max_size = max_size
+	
+	def path (self, key):
+		return self.directory / (key + '.npz')
+	
+	def get (self, key):
+		path = self.path(key)
+		# another process may evict the entry at any time
+		try:
+			# the modification time orders the entries for eviction
+			os.utime(str(path))
+			return load_results(path)
+		except FileNotFoundError:
+			return None
+	
+	def put (self, key, write):
+		partial = partial_path(self.path(key))
+		write(partial)
+		os.replace(str(partial), str(self.path(key)))
+		self.evict()
+	
+	def outputs_path (self, key):
+		return self.directory / (key + '.outputs.json')
+	
+	def outputs (self, key):
+		# output files written for the entry, None once any of them is gone
+		try:
+			with open(str(self.outputs_path(key)), 'r') as outputs_file:
+				output_files = [ Path(output)
+								 for output in json.load(outputs_file) ]
+		except (OSError, ValueError):
+			return None
+		if not all(output.exists() for output in output_files):
+			return None
+		return output_files
+	
+	def set_outputs (self, key, output_files):
+		path = self.outputs_path(key)
+		partial = partial_path(path)
+		with open(str(partial), 'w') as outputs_file:
+			json.dump([ str(Path(output).resolve())
+						for output in output_files ], outputs_file)
+		os.replace(str(partial), str(path))
+	
+	def evict (self):
+		entries = []
+		for path in self.directory.glob('*.npz'):
+			if path.name.endswith('.partial.npz'):
+				continue
+			try:
+				file_stat = path.stat()
+			except FileNotFoundError:
+				continue
+			entries.append((file_stat.st_mtime, file_stat.st_size, path))
+		total_size = sum(size for _, size, _ in entries)
+		for _, size, path in sorted(entries):
+			if total_size <= self.max_size:
+				break
+			total_size -= size
+			for stale in (path, path.with_suffix('.outputs.json')):
+				try:
+					stale.unlink()
+				except FileNotFoundError:
+					pass
+
+################################################################################
+# sidecar with the parsed metadata and frame offsets of ND2 files #
+###################################################################
+
+sidecar_version = 1
+
+def sidecar_path (fingerprint):
+	text = json.dumps({'file': fingerprint, 'version': sidecar_version},
+					  sort_keys = True)
+	return cache_directory('metadata') / \
+				(hashlib.sha256(text.encode()).hexdigest() + '.json')
+
+def stack_metadata (reader):
+	sizes = {key: int(value) for key, value in reader.sizes.items()}
+	metadata = {'sizes': sizes,
+				'pixel_microns': float(reader.metadata['pixel_microns']),
+				'z_coordinates': [ float(z_coordinate) for z_coordinate in
+								reader.metadata.get('z_coordinates') or [] ],
+				'channels': list(reader.metadata['channels']),
+				'height': int(reader.metadata['height']),
+				'width': int(reader.metadata['width']),
+				'frame_offsets': None}
+	# the offsets come from nd2reader internals, without them the frames
+	# are read through nd2reader
+	try:
+		parser = reader.parser
+		metadata['frame_offsets'] = [ int(
+				parser._label_map.get_image_data_location(
+					parser._calculate_image_group_number(0, 0, z_level)))
+										for z_level in range(sizes['z']) ]
+	except Exception:
+		pass
+	return metadata
+
+def decode_frame (data, channel, height, width):
+	# the first four values hold the time stamp and the channels are
+	# interleaved, the padded rows of stitched files are left to nd2reader
+	pixels = np.frombuffer(data, dtype = np.uint16)[4:]
+	if len(pixels) % (height * width) != 0:
+		return None
+	channels = len(pixels) // (height * width)
+	return np.ascontiguousarray(pixels.reshape(height, width,
+											   channels)[:,:,channel])
+
+class IndexedStack ():
+	# stands in for ND2Reader with the metadata of the sidecar
+	def __init__ (self, file_path, metadata, reader = None):
+		self.file_path = Path(file_path)
+		self.sizes = metadata['sizes']
+		self.metadata = metadata
+		self.frame_offsets = metadata['frame_offsets']
+		self.reader = reader
+		self.file = None
+		self.lock = threading.Lock()
+	
+	def get_frame_2D (self, c = 0, z = 0):
+		frame = None
+		if self.frame_offsets is not None:
+			frame = decode_frame(self.read_chunk(self.frame_offsets[z]), c,
+								 self.metadata['height'],
+								 self.metadata['width'])
+		if frame is not None:
+			return frame
+		with self.lock:
+			if self.reader is None:
+				from nd2reader import ND2Reader
+				self.reader = ND2Reader(str(self.file_path))
+			return self.reader.get_frame_2D(c = c, z = z)
+	
+	def read_chunk (self, offset):
+		with self.lock:
+			if self.file is None:
+				self.file = open(str(self.file_path), 'rb')
+			self.file.seek(offset)
+			header, relative_offset, data_length = \
+									struct.unpack('IIQ', self.file.read(16))
+			if header != 0xabeceda:
+				raise ValueError('The ND2 file seems to be corrupted.')
+			self.file.seek(offset + 16 + relative_offset)
+			return self.file.read(data_length)
+	
+	def close (self):
+		with self.lock:
+			if self.file is not None:
+				self.file.close()
+				self.file = None
+			if self.reader is not None:
+				self.reader.close()
+				self.reader = None
+
+def open_indexed_stack (file_path):
+	path = sidecar_path(file_fingerprint(file_path))
+	try:
+		with open(str(path), 'r') as sidecar_file:
+			return IndexedStack(file_path, json.load(sidecar_file))
+	except (OSError, ValueError):
+		pass
+	from nd2reader import ND2Reader
+	reader = ND2Reader(str(file_path))
+	metadata = stack_metadata(reader)
+	try:
+		partial = partial_path(path)
+		with open(str(partial), 'w') as sidecar_file:
+			json.dump(metadata, sidecar_file)
+		os.replace(str(partial), str(path))
+	except OSError:
+		pass
+	return IndexedStack(file_path, metadata, reader)
+
+################################################################################
+# checkpoints of interrupted runs #
+###################################
+
+def slice_name (z_level):
+	return 'slice_{0:05d}'.format(z_level)
+
+class Checkpoint ():
+	def __init__ (self, directory):
+		self.directory = Path(directory)
+	
+	def path (self, name):
+		return self.directory / (name + '.npz')
+	
+	def exists (self, name):
+		return self.path(name).exists()
+	
+	def save (self, name, **arrays):
+		partial = partial_path(self.path(name))
+		np.savez(str(partial), **arrays)
+		os.replace(str(partial), str(self.path(name)))
+	
+	def load (self, name):
+		try:
+			with np.load(str(self.path(name))) as npz_file:
+				return {key: npz_file[key] for key in npz_file.files}
+		except FileNotFoundError:
+			return None
+	
+	def clear (self):
+		shutil.rmtree(str(self.directory), ignore_errors = True)
+
+################################################################################
+# class for triangulation #
+###########################
+
+class SimplicialComplex ():
+	def __init__ (self, points = None,
+						simplices = None,
+						neighbours = None):
+		self.points = points
+		self.simplices = simplices
+		self.neighbours = neighbours
+		self.longest_edges = None
+		if simplices is not None:
+			self.calc_longest_edges()
+	
+	def calc_longest_edges (self, batch_size = 500000):
+		# vertex pairs are compared batch by batch to bound the memory use
+		self.longest_edges = np.zeros(self.simplices.shape[0], dtype = float)
+		dimension = self.simplices.shape[1]
+		for start in range(0, self.simplices.shape[0], batch_size):
+			simplices = self.simplices[start:start+batch_size]
+			longest_edges = self.longest_edges[start:start+batch_size]
+			for first in range(dimension):
+				for second in range(first+1, dimension):
+					np.maximum(longest_edges, np.linalg.norm(
+									self.points[simplices[:,first]] - \
+									self.points[simplices[:,second]],
+										axis=-1), out = longest_edges)
+	
+	def remove_simplex (self, index):
+		self.neighbours[self.neighbours == index] = -1
+		self.neighbours[self.neighbours > index] -= 1
+		self.neighbours = np.delete(self.neighbours, index, axis=0)
+		self.simplices = np.delete(self.simplices, index, axis=0)
+		self.longest_edges = np.delete(self.longest_edges, index)
+	
+	def remove_simplices (self, mask):
+		keep = np.logical_not(mask)
+		new_index = np.cumsum(keep) - 1
+		neighbours = self.neighbours[keep]
+		valid = (neighbours >= 0)
+		valid[valid] = keep[neighbours[valid]]
+		self.neighbours = np.where(valid, new_index[neighbours], -1)
+		self.simplices = self.simplices[keep]
+		self.longest_edges = self.longest_edges[keep]
+	
+	def remove_long_simplices (self, length):
+		self.remove_simplices(self.longest_edges > length)
+	
+	def facets (self):
+		# every facet is listed once, either by the lower indexed of the two
+		# simplices sharing it or by its only simplex if it is on the boundary
+		dimension = self.simplices.shape[1]
+		facets = np.vstack([np.delete(self.simplices, vertex, axis=1)
+								for vertex in range(dimension)])
+		neighbours = self.neighbours.T.ravel()
+		owners = np.tile(np.arange(self.simplices.shape[0]), dimension)
+		unique = (neighbours == -1) | (owners < neighbours)
+		return np.sort(facets[unique], axis=1), (neighbours[unique] == -1)
+	
+	def edges (self):
+		# vertex pairs of the remaining simplices, each pair listed once
+		dimension = self.simplices.shape[1]
+		pairs = np.sort(np.vstack([self.simplices[:,[first,second]]
+									for first in range(dimension)
+										for second in range(first+1,
+															dimension)]),
+						axis=1)
+		count = self.points.shape[0]
+		keys = np.unique(pairs[:,0].astype(np.int64) * count + pairs[:,1])
+		return np.column_stack([keys // count, keys % count])
+
+################################################################################
+# functions for triangulating large point clouds in blocks #
+############################################################
+
+def simplex_neighbours (simplices):
+	count, dimension = simplices.shape
+	facets = np.sort(np.vstack([np.delete(simplices, vertex, axis=1)
+								for vertex in range(dimension)]), axis=1)
+	owners = np.tile(np.arange(count), dimension)
+	slots = np.repeat(np.arange(dimension), count)
+	order = np.lexsort(facets.T[::-1])
+	shared = np.all(facets[order[1:]] == facets[order[:-1]], axis=1)
+	if np.any(shared[1:] & shared[:-1]):
+		raise ValueError('facet shared by more than two simplices')
+	first = order[:-1][shared]
+	second = order[1:][shared]
+	neighbours = np.full((count, dimension), -1, dtype = int)
+	neighbours[owners[first], slots[first]] = owners[second]
+	neighbours[owners[second], slots[second]] = owners[first]
+	return neighbours
+
+def circumspheres (points, simplices):
+	# centre and radius of the sphere through the vertices of each simplex,
+	# flat simplices get an infinite radius
+	vertices = points[simplices]
+	edges = vertices[:,1:] - vertices[:,:1]
+	lengths = np.sum(edges**2, axis=2)/2
+	determinants = np.linalg.det(edges)
+	scale = np.amax(lengths, axis=1)**(edges.shape[1]/2)
+	flat = np.abs(determinants) <= 1e-12*np.maximum(scale, 1e-300)
+	edges[flat] = np.eye(edges.shape[1])
+	offsets = np.linalg.solve(edges, lengths[:,:,None])[:,:,0]
+	centres = vertices[:,0] + offsets
+	radii = np.sqrt(np.sum(offsets**2, axis=1))
+	radii[flat] = np.inf
+	return centres, radii
+
+def chunked_triangulation (points, edge_max, block_points = 200000):
+	# triangulate overlapping blocks in the xy plane and keep the short
+	# simplices whose centroid lies in the core of the block. a kept simplex
+	# is the global delaunay simplex when no point outside the block lies in
+	# its circumsphere, otherwise the block is widened and triangulated again
+	dimension = points.shape[1]
+	lower = np.amin(points[:,:2], axis=0)
+	upper = np.amax(points[:,:2], axis=0)
+	blocks = max(1, int(np.ceil(np.sqrt(points.shape[0]/block_points))))
+	width = np.maximum((upper - lower)/blocks, np.finfo(float).eps)
+	from scipy.spatial import Delaunay, cKDTree, QhullError
+	tree = None
+	simplices = [np.zeros((0,dimension+1), dtype = int)]
+	for block_x in range(blocks):
+		for block_y in range(blocks):
+			core_lower = lower + width*np.array([block_x, block_y])
+			core_upper = core_lower + width
+			margin = 2*edge_max
+			while True:
+				region_lower = core_lower - margin
+				region_upper = core_upper + margin
+				inside = np.all((points[:,:2] >= region_lower) & \
+								(points[:,:2] <= region_upper), axis=1)
+				indices = np.flatnonzero(inside)
+				if len(indices) < dimension+1:
+					block_simplices = simplices[0]
+					break
+				try:
+					triangulation = Delaunay(points[indices])
+				except QhullError:
+					block_simplices = simplices[0]
+					break
+				block = SimplicialComplex(triangulation.points,
+										  triangulation.simplices)
+				block_simplices = indices[
+						triangulation.simplices[block.longest_edges <= edge_max]]
+				centroids = np.mean(points[block_simplices,:2], axis=1)
+				owner = np.clip(np.floor((centroids - lower)/width).astype(int),
+								0, blocks-1)
+				block_simplices = block_simplices[(owner[:,0] == block_x) & \
+												  (owner[:,1] == block_y)]
+				if np.all(inside):
+					break
+				# spheres that only reach beyond the block outside the cloud
+				# can't hold a missing point
+				centres, radii = circumspheres(points, block_simplices)
+				reach_lower = np.maximum(centres[:,:2] - radii[:,None], lower)
+				reach_upper = np.minimum(centres[:,:2] + radii[:,None], upper)
+				uncertain = np.flatnonzero(np.isfinite(radii) & np.any(
+									(reach_lower < region_lower) | \
+									(reach_upper > region_upper), axis=1))
+				if len(uncertain) == 0:
+					break
+				if tree is None:
+					tree = cKDTree(points)
+				violated = []
+				for simplex in uncertain:
+					nearby = tree.query_ball_point(centres[simplex],
+												   radii[simplex])
+					nearby = np.array(nearby, dtype = int)
+					nearby = nearby[~inside[nearby]]
+					distances = np.sqrt(np.sum((points[nearby] - \
+												centres[simplex])**2, axis=1))
+					if np.any(distances < radii[simplex]*(1 - 1e-9)):
+						violated.append(simplex)
+				if len(violated) == 0:
+					break
+				margin = max(2*margin, np.amax(np.maximum(
+							core_lower - reach_lower[violated],
+							reach_upper[violated] - core_upper)) + edge_max)
+			simplices.append(block_simplices)
+	simplices = np.vstack(simplices)
+	return SimplicialComplex(points, simplices, simplex_neighbours(simplices))
+
+################################################################################
+# sparse neighbour graph of the nuclei #
+########################################
+
+def adjacency_matrix (edges, count):
+	from scipy.sparse import csr_matrix
+	rows = np.concatenate([edges[:,0], edges[:,1]])
+	columns = np.concatenate([edges[:,1], edges[:,0]])
+	return csr_matrix((np.ones(len(rows), dtype = np.int8), (rows, columns)),
+					  shape = (count, count))
+
+def graph_arrays (adjacency):
+	# the matrix is stored with the results as its index arrays, all
+	# entries are one
+	if adjacency is None:
+		return {}
+	return {'graph_indptr': adjacency.indptr.astype(np.int64),
+			'graph_indices': adjacency.indices.astype(np.int64)}
+
+def load_graph (arrays):
+	if 'graph_indptr' not in arrays:
+		return None
+	from scipy.sparse import csr_matrix
+	indptr = arrays['graph_indptr']
+	indices = arrays['graph_indices']
+	count = len(indptr) - 1
+	return csr_matrix((np.ones(len(indices), dtype = np.int8), indices,
+					   indptr), shape = (count, count))
+
+def neighbour_counts (adjacency):
+	return np.diff(adjacency.indptr)
+
+def neighbour_fractions (adjacency, cells):
+	# fraction of the neighbours of every nucleus that are positive, nan
+	# for nuclei without neighbours
+	counts = neighbour_counts(adjacency)
+	positive = adjacency @ np.asarray(cells, dtype = float)
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		return np.where(counts > 0, positive / counts, np.nan)
+
+################################################################################
+# spatial index over the result positions #
+###########################################
+
+class SpatialIndex ():
+	# the nuclei sorted by the key of their cell on a regular grid, the
+	# cells of a column along z are contiguous so that a box is found with
+	# two binary searches per column
+	def __init__ (self, positions, cell_size = None, arrays = None):
+		self.positions = np.asarray(positions, dtype = float)
+		if arrays is not None:
+			self.origin = arrays['index_origin']
+			self.cell_size = float(arrays['index_cell'])
+			self.shape = arrays['index_shape']
+			self.order = arrays['index_order']
+			self.keys = arrays['index_keys']
+			return
+		count = max(1, self.positions.shape[0])
+		self.origin = np.zeros(3)
+		extent = np.zeros(3)
+		if self.positions.shape[0] > 0:
+			self.origin = np.amin(self.positions, axis=0)
+			extent = np.amax(self.positions, axis=0) - self.origin
+		if cell_size is None:
+			# about eight nuclei per occupied cell, from the volume of the
+			# dimensions that are thicker than a cell so that flat or single
+			# slice samples do not end up with tiny cells
+			cell_size = 1.
+			occupied = extent > 0
+			while np.any(occupied):
+				cell_size = (8 * np.prod(extent[occupied]) / count) ** \
+										(1 / np.count_nonzero(occupied))
+				thin = occupied & (extent < cell_size)
+				if not np.any(thin):
+					break
+				occupied &= ~thin
+		self.cell_size = float(max(cell_size, 1e-6))
+		self.shape = np.floor(extent / self.cell_size).astype(np.int64) + 1
+		keys = np.ravel_multi_index(tuple(self.cells(self.positions).T),
+									tuple(self.shape))
+		self.order = np.argsort(keys, kind = 'stable')
+		self.keys = keys[self.order]
+	
+	def arrays (self):
+		return {'index_origin': self.origin,
+				'index_cell': np.array(self.cell_size),
+				'index_shape': self.shape,
+				'index_order': self.order,
+				'index_keys': self.keys}
+	
+	def cells (self, points):
+		return np.clip(np.floor((np.atleast_2d(points) - self.origin) / \
+								self.cell_size).astype(np.int64),
+					   0, self.shape - 1)
+	
+	def candidates (self, lower, upper):
+		if np.any(np.asarray(upper) < self.origin) or \
+		   np.any(np.asarray(lower) > self.origin + self.shape*self.cell_size):
+			return np.zeros(0, dtype = np.int64)
+		lower_cell, upper_cell = self.cells(np.vstack([lower, upper]))
+		columns_x, columns_y = np.meshgrid(
+							np.arange(lower_cell[0], upper_cell[0]+1),
+							np.arange(lower_cell[1], upper_cell[1]+1),
+							indexing = 'ij')
+		first = (columns_x.ravel() * self.shape[1] + columns_y.ravel()) * \
+															self.shape[2]
+		starts = np.searchsorted(self.keys, first + lower_cell[2], 'left')
+		stops = np.searchsorted(self.keys, first + upper_cell[2], 'right')
+		counts = stops - starts
+		if counts.sum() == 0:
+			return np.zeros(0, dtype = np.int64)
+		slots = np.repeat(starts - np.cumsum(counts) + counts, counts) + \
+											np.arange(counts.sum())
+		return self.order[slots]
+	
+	def box (self, lower, upper):
+		lower = np.asarray(lower, dtype = float)
+		upper = np.asarray(upper, dtype = float)
+		indices = self.candidates(lower, upper)
+		inside = np.all((self.positions[indices] >= lower) & \
+						(self.positions[indices] <= upper), axis=1)
+		return np.sort(indices[inside])
+	
+	def radius (self, centre, radius):
+		centre = np.asarray(centre, dtype = float)
+		indices = self.candidates(centre - radius, centre + radius)
+		distances = np.linalg.norm(self.positions[indices] - centre, axis=1)
+		return np.sort(indices[distances <= radius])
+	
+	def nearest (self, point, k = 1):
+		# the box grows from the edge of the grid until it holds k nuclei
+		# within the sphere it encloses, at the latest once the sphere
+		# holds the whole grid
+		point = np.asarray(point, dtype = float)
+		k = min(k, self.positions.shape[0])
+		if k == 0:
+			return np.zeros(0, dtype = np.int64), np.zeros(0)
+		lower = self.origin
+		upper = self.origin + self.shape * self.cell_size
+		outside = np.linalg.norm(np.maximum(np.maximum(lower - point,
+													   point - upper), 0.))
+		farthest = np.linalg.norm(np.maximum(np.abs(point - lower),
+											 np.abs(point - upper)))
+		reach = outside + self.cell_size
+		while True:
+			indices = self.candidates(point - reach, point + reach)
+			distances = np.linalg.norm(self.positions[indices] - point, axis=1)
+			within = distances <= reach
+			if np.count_nonzero(within) >= k or reach >= farthest:
+				indices = indices[within]
+				distances = distances[within]
+				closest = np.argsort(distances, kind = 'stable')[:k]
+				return indices[closest], distances[closest]
+			reach *= 2
+
+def slice_index (first, last, z_size):
+	# nuclei listed by the slices they span, the nuclei of slice z are
+	# members[offsets[z]:offsets[z+1]]
+	first = np.clip(first, 0, z_size-1)
+	last = np.clip(last, first, z_size-1)
+	counts = last - first + 1
+	nucleus = np.repeat(np.arange(len(first)), counts)
+	slices = np.repeat(first - np.cumsum(counts) + counts, counts) + \
+										np.arange(counts.sum())
+	order = np.argsort(slices, kind = 'stable')
+	offsets = np.append(0, np.cumsum(np.bincount(slices, minlength = z_size)))
+	return nucleus[order], offsets
+
+def load_index (positions, arrays):
+	if 'index_order' not in arrays or \
+	   len(arrays['index_order']) != len(positions):
+		return SpatialIndex(positions)
+	return SpatialIndex(positions, arrays = arrays)
+
+################################################################################
+# function for distances to the tissue surface on a voxel grid #
+################################################################
+
+def voxel_surface_distances (positions, red_cells, spacing, radius,
+												bounds, open_sides):
+	from scipy import ndimage as ndi
+	padding = np.ceil(radius/spacing).astype(int) + 2
+	origin = np.amin(positions, axis=0) - padding*spacing
+	voxels = np.round((positions - origin)/spacing).astype(int)
+	shape = np.amax(voxels, axis=0) + padding + 1
+	voxel_index = tuple(voxels.T)
+	occupied = np.zeros(shape, dtype = bool)
+	occupied[voxel_index] = True
+	labels = np.zeros(shape, dtype = np.int32)
+	labels[voxel_index] = np.arange(1, positions.shape[0]+1)
+	# closing the nuclei with a ball of the given radius gives the tissue
+	tissue = ndi.distance_transform_edt(np.logical_not(occupied),
+										sampling = spacing) <= radius
+	tissue = ndi.distance_transform_edt(tissue, sampling = spacing) > radius
+	tissue[voxel_index] = True
+	tissue = ndi.binary_fill_holes(tissue)
+	# continue the tissue through the sides where the region of interest
+	# cuts it, so that no surface is found there
+	band = np.ceil(radius/spacing).astype(int)
+	for axis in range(3):
+		for side in range(2):
+			if not open_sides[axis,side]:
+				continue
+			bound = int(np.clip(np.round((bounds[axis,side] - origin[axis]) / \
+											spacing[axis]), 0, shape[axis]-1))
+			slab = [slice(None)]*3
+			if side == 0:
+				slab[axis] = slice(0, bound+band[axis]+1)
+			else:
+				slab[axis] = slice(max(bound-band[axis], 0), None)
+			tissue[tuple(slab)] |= np.any(tissue[tuple(slab)], axis=axis,
+														keepdims = True)
+	if np.all(tissue):
+		return np.full(positions.shape[0], np.inf), \
+			   np.zeros(positions.shape[0], dtype = bool)
+	distances, nearest_outside = ndi.distance_transform_edt(tissue,
+								sampling = spacing, return_indices = True)
+	nearest_nucleus = ndi.distance_transform_edt(np.logical_not(occupied),
+								sampling = spacing, return_distances = False,
+								return_indices = True)
+	outside_voxels = tuple(nearest_outside[(slice(None),) + voxel_index])
+	closest = labels[tuple(nearest_nucleus[(slice(None),) + \
+											outside_voxels])] - 1
+	return distances[voxel_index], red_cells[closest]
+
+################################################################################
+# cheap statistics for finding slices without tissue #
+######################################################
+
+def slice_statistics (frame, step = 4):
+	# percentiles and spread of a subsampled frame
+	sample = np.asarray(frame[::step,::step], dtype = float)
+	if sample.size == 0:
+		return np.zeros(4)
+	low, median, high = np.percentile(sample, [1, 50, 99])
+	return np.array([low, median, high, np.std(sample)])
+
+# channel histograms count the intensities in bins of 16
+histogram_shift = 4
+histogram_bins = 65536 >> histogram_shift
+
+def channel_histograms (frames, step = 4):
+	histograms = np.zeros((3, histogram_bins), dtype = np.int64)
+	for index, frame in enumerate(frames):
+		sample = np.asarray(frame[::step,::step]).astype(np.int64).ravel()
+		if sample.size > 0:
+			histograms[index] = np.bincount(np.clip(sample >> histogram_shift,
+													0, histogram_bins-1),
+											minlength = histogram_bins)
+	return histograms
+
+def histogram_percentile (histogram, fraction):
+	cumulative = np.cumsum(histogram)
+	if cumulative[-1] == 0:
+		return 0
+	index = np.searchsorted(cumulative, fraction * cumulative[-1])
+	return int(index) << histogram_shift
+
+def otsu_threshold (histogram):
+	centres = (np.arange(histogram_bins) << histogram_shift) + \
+											(1 << histogram_shift) // 2
+	weights = np.cumsum(histogram).astype(float)
+	sums = np.cumsum(histogram * centres).astype(float)
+	if weights[-1] == 0:
+		return 0
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		mean_lower = sums / weights
+		mean_upper = (sums[-1] - sums) / (weights[-1] - weights)
+		between = weights * (weights[-1] - weights) * \
+									(mean_lower - mean_upper)**2
+	return int(centres[np.argmax(np.nan_to_num(between))])
+
+def dog_blobs (frame, sigma_min, sigma_max, scales = 3):
+	# difference of gaussians over a pyramid, every octave is blurred in
+	# small steps and halved once its blur has doubled so that the larger
+	# scales are found on smaller images
+	from scipy import ndimage as ndi
+	step = 2**(1/scales)
+	image = ndi.gaussian_filter(np.asarray(frame, dtype = np.float32),
+								sigma_min)
+	base = image
+	positions = []
+	responses = []
+	values = []
+	factor = 1
+	while sigma_min * factor <= sigma_max * step and min(image.shape) >= 8:
+		levels = [image]
+		for index in range(scales+2):
+			sigma = sigma_min * step**index
+			levels.append(ndi.gaussian_filter(levels[-1],
+									sigma * np.sqrt(step**2 - 1)))
+		levels = np.array(levels)
+		# scale normalised so that a blob answers with about its contrast
+		dog = (levels[:-1] - levels[1:]) * (4 / (step**2 - 1))
+		peaks = (dog == ndi.maximum_filter(dog, size = 3))
+		peaks[0] = False
+		peaks[-1] = False
+		level, y, x = np.nonzero(peaks)
+		positions.append(np.column_stack([x, y]) * factor + (factor-1) // 2)
+		responses.append(dog[level, y, x])
+		values.append(levels[level, y, x])
+		image = levels[scales][::2,::2]
+		factor *= 2
+	if len(positions) == 0:
+		positions = [np.zeros((0,2), dtype = int)]
+	positions = np.vstack(positions)
+	inside = (positions[:,0] < frame.shape[1]) & \
+			 (positions[:,1] < frame.shape[0])
+	return {'positions': positions[inside],
+			'responses': np.concatenate(responses)[inside] \
+										if len(responses) else np.zeros(0),
+			'values': np.concatenate(values)[inside] \
+										if len(values) else np.zeros(0),
+			'base': base}
+
+def label_medians (image, labels, count):
+	from scipy import ndimage as ndi
+	if count == 0:
+		return np.zeros(0)
+	return np.asarray(ndi.median(image, labels, np.arange(1, count+1)),
+					  dtype = float)
+
+def signal_slices (statistics, signal):
+	# a slice has tissue when its bright end stands out from its median by a
+	# fraction of the best slice
+	contrast = statistics[:,2] - statistics[:,1]
+	return contrast >= signal * np.amax(contrast, initial = 0.)
+
+################################################################################
+# binned frames for quick previews #
+####################################
+
+def bin_frame (frame, factor):
+	height = frame.shape[0] // factor * factor
+	width = frame.shape[1] // factor * factor
+	return frame[:height,:width].reshape(height // factor, factor,
+										 width // factor, factor).mean(
+																axis = (1,3))
+
+################################################################################
+# reusable per-thread scratch buffers for frames #
+##################################################
+
+frame_buffer_store = threading.local()
+
+def frame_buffer (name, shape, dtype = np.float32):
+	buffers = getattr(frame_buffer_store, 'buffers', None)
+	if buffers is None:
+		buffers = frame_buffer_store.buffers = {}
+	buffer = buffers.get(name)
+	if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+		buffer = np.empty(shape, dtype = dtype)
+		buffers[name] = buffer
+	return buffer
+
+def blur_frame (frame, deviation, name):
+	# the gaussian of mahotas is scipy's in reflect mode truncated at four
+	# deviations, so this differs from the default path only by the float32
+	# precision of the buffer
+	from scipy import ndimage as ndi
+	blur = frame_buffer(name, frame.shape)
+	ndi.gaussian_filter(frame, deviation, output = blur)
+	return blur
+
+################################################################################
+# functions for binary result files #
+#####################################
+
+FLAG_GREEN = 1
+FLAG_RED = 2
+FLAG_EPI = 4
+
+result_dtype = np.dtype([ ('positions', np.float64, 3),
+						  ('flags', np.uint8) ])
+
+def pack_flags (green_cells, red_cells, epi_cells):
+	flags = np.zeros(len(green_cells), dtype = np.uint8)
+	flags[np.asarray(green_cells, dtype = bool)] |= FLAG_GREEN
+	flags[np.asarray(red_cells, dtype = bool)] |= FLAG_RED
+	flags[np.asarray(epi_cells, dtype = bool)] |= FLAG_EPI
+	return flags
+
+def unpack_flags (flags):
+	return (flags & FLAG_GREEN) > 0, (flags & FLAG_RED) > 0, \
+		   (flags & FLAG_EPI) > 0
+
+EDGE_OUTER = 1
+EDGE_RED = 2
+EDGE_GREEN = 4
+
+layer_dtype = np.dtype([ ('positions', np.float64, 3),
+						 ('green', np.float64),
+						 ('red', np.float64),
+						 ('area', np.float64) ])
+
+edge_dtype = np.dtype([ ('vertices', np.int64, 2),
+						('flags', np.uint8) ])
+
+class ResultTable ():
+	# rows of a structured array preallocated in chunks, the rows and
+	# columns handed out are views so that every holder sees the same data
+	chunk_size = 4096
+	
+	def __init__ (self, dtype = result_dtype, rows = None):
+		if rows is None:
+			self.data = np.zeros(0, dtype = dtype)
+			self.size = 0
+		else:
+			self.data = rows
+			self.size = rows.shape[0]
+	
+	def __len__ (self):
+		return self.size
+	
+	def rows (self):
+		return self.data[:self.size]
+	
+	def reserve (self, count):
+		needed = self.size + count
+		if needed <= self.data.shape[0]:
+			return
+		capacity = max(needed, 2*self.data.shape[0])
+		capacity = -(-capacity // self.chunk_size) * self.chunk_size
+		data = np.zeros(capacity, dtype = self.data.dtype)
+		data[:self.size] = self.data[:self.size]
+		self.data = data
+	
+	def append (self, **columns):
+		count = len(next(iter(columns.values())))
+		self.reserve(count)
+		for name, values in columns.items():
+			self.data[name][self.size:self.size+count] = values
+		self.size += count
+	
+	def clear (self):
+		self.size = 0
+	
+	def flag (self, bit):
+		return (self.rows()['flags'] & bit) > 0
+	
+	def set_flag (self, bit, mask):
+		flags = self.rows()['flags']
+		flags[...] = np.where(mask, flags | bit, flags & ~np.uint8(bit))
+	
+	def cells (self):
+		return unpack_flags(self.rows()['flags'])
+
+def result_table (positions, green_cells, red_cells, epi_cells):
+	table = ResultTable(result_dtype)
+	table.append(positions = positions,
+				 flags = pack_flags(green_cells, red_cells, epi_cells))
+	return table
+
+def vote_cells (layer_cells, layer_offsets):
+	# majority vote over the layers belonging to each linked nucleus
+	counts = np.diff(layer_offsets)
+	nucleus = np.repeat(np.arange(len(counts)), counts)
+	positive = np.bincount(nucleus, weights = layer_cells,
+							minlength = len(counts))
+	return positive >= counts/2
+
+def save_results (file_path, results, parameters = None, scale = None,
+					roi = None, **extra_arrays):
+	# stored uncompressed so that the results can be memory mapped, extra
+	# arrays that are None are left out
+	if parameters is None:
+		parameters = {}
+	if scale is None:
+		scale = np.ones(3)
+	if roi is None:
+		roi = np.zeros(6)
+	np.savez(str(file_path), results = results.rows(),
+			 parameters = np.array(json.dumps(parameters)),
+			 scale = np.asarray(scale, dtype = float),
+			 roi = np.asarray(roi, dtype = int),
+			 **{name: array for name, array in extra_arrays.items()
+					if array is not None})
+
+def memmap_npz (file_path, name):
+	with zipfile.ZipFile(str(file_path)) as archive:
+		info = archive.getinfo(name + '.npy')
+	if info.compress_type != zipfile.ZIP_STORED:
+		with np.load(str(file_path)) as npz_file:
+			return npz_file[name]
+	with open(str(file_path), 'rb') as file:
+		file.seek(info.header_offset)
+		local_header = file.read(30)
+		name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+		file.seek(info.header_offset + 30 + name_length + extra_length)
+		version = np.lib.format.read_magic(file)
+		if version == (1,0):
+			shape, fortran_order, dtype = \
+							np.lib.format.read_array_header_1_0(file)
+		else:
+			shape, fortran_order, dtype = \
+							np.lib.format.read_array_header_2_0(file)
+		offset = file.tell()
+	if dtype.hasobject:
+		raise ValueError('Object arrays can not be memory mapped.')
+	if np.prod(shape) == 0:
+		return np.zeros(shape, dtype = dtype)
+	return np.memmap(str(file_path), dtype = dtype, mode = 'r',
+					 offset = offset, shape = shape,
+					 order = 'F' if fortran_order else 'C')
+
+def load_results (file_path):
+	with np.load(str(file_path)) as npz_file:
+		parameters = json.loads(str(npz_file['parameters']))
+		scale = npz_file['scale']
+		roi = npz_file['roi']
+		extra_arrays = {name: npz_file[name] for name in npz_file.files
+							if name not in ('results', 'parameters',
+											'scale', 'roi')}
+	results = memmap_npz(file_path, 'results')
+	return results, parameters, scale, roi, extra_arrays
+
+################################################################################
+# parameter profiles #
+######################
+
+def profile_directory ():
+	root = os.environ.get('ND2PLOTTER_PROFILES',
+						  str(Path.home() / '.config' / 'ND2Plotter'))
+	return Path(root) / 'profiles'
+
+def profile_path (name):
+	return profile_directory() / (name + '.json')
+
+def load_profile (name):
+	with open(str(profile_path(name)), 'r') as profile_file:
+		return json.load(profile_file)
+
+def save_profile (name, parameters):
+	profile_directory().mkdir(parents = True, exist_ok = True)
+	with open(str(profile_path(name)), 'w') as profile_file:
+		json.dump(parameters, profile_file, indent = 1, sort_keys = True)
+
+################################################################################
+# processing pipeline without the window #
+##########################################
+
+class NoProgress ():
+	# stands in for the progress bar when there is no window
+	def setRange (self, minimum, maximum):
+		pass
+	
+	def setMinimum (self, minimum):
+		pass
+	
+	def setMaximum (self, maximum):
+		pass
+	
+	def setValue (self, value):
+		pass
+	
+	def setFormat (self, text):
+		pass
+	
+	def reset (self):
+		pass
+
+class Pipeline ():
+	parameter_names = ['green_active', 'red_active', 'geometry_active',
+					   'green_cutoff_active', 'red_cutoff_active',
+					   'green_lower', 'green_upper', 'green_cutoff',
+					   'red_lower', 'red_upper', 'red_cutoff',
+					   'geo_edge_max', 'geo_distance', 'geo_dist_red',
+					   'geo_chunked', 'geo_engine',
+					   'neighbourhood_size', 'threshold_difference',
+					   'minimum_distance', 'gauss_deviation',
+					   'max_layer_distance', 'number_layer_cell',
+					   'low_memory', 'skip_empty', 'slice_signal',
+					   'stack_reference', 'segmentation', 'detector']
+	
+	def __init__ (self):
+		self.green_active = True
+		self.red_active = True
+		self.geometry_active = True
+		self.geo_chunked = False
+		self.geo_engine = 'mesh'
+		self.green_cutoff_active = False
+		self.red_cutoff_active = False
+		self.threshold_defaults = np.array([180,2000,4095,4095,
+											320,2000,4095,4095,
+											50,40,10])
+		self.green_lower = self.threshold_defaults[0]
+		self.green_upper = self.threshold_defaults[1]
+		self.green_cutoff = self.threshold_defaults[2]
+		self.green_max = self.threshold_defaults[3]
+		self.red_lower = self.threshold_defaults[4]
+		self.red_upper = self.threshold_defaults[5]
+		self.red_cutoff = self.threshold_defaults[6]
+		self.red_max = self.threshold_defaults[7]
+		self.geo_edge_max = self.threshold_defaults[8]
+		self.geo_distance = self.threshold_defaults[9]
+		self.geo_dist_red = self.threshold_defaults[10]
+		self.geo_size = int(512/8)
+		self.x_lower = 0
+		self.x_upper = 0
+		self.x_size = 512
+		self.y_lower = 0
+		self.y_upper = 0
+		self.y_size = 512
+		self.z_size = 1
+		self.z_lower = 0
+		self.z_upper = 0
+		self.nd2_file = None
+		self.czi_file = None
+		self.image_stack = None
+		self.advanced_defaults = np.array([9,1,4,2,6,4])
+		self.neighbourhood_size = self.advanced_defaults[0]
+		self.threshold_difference = self.advanced_defaults[1]
+		self.minimum_distance = self.advanced_defaults[2]
+		self.gauss_deviation = self.advanced_defaults[3]
+		self.max_layer_distance = self.advanced_defaults[4]
+		self.number_layer_cell = self.advanced_defaults[5]
+		self.low_memory = False
+		self.skip_empty = False
+		self.slice_signal = 0.1
+		self.skipped_slices = 0
+		self.stack_reference = False
+		self.segmentation = 'box'
+		self.detector = 'maxima'
+		self.dapi_reference = None
+		self.workers = max(1, (os.cpu_count() or 2) - 1)
+		self.queue_depth = 2*self.workers
+		self.use_cache = True
+		self.resume_run = True
+		self.result_cache = ResultCache()
+		self.scale = np.array([0.232, 0.232, 0.479])
+		self.mesh = None
+		self.results = None
+		self.adjacency = None
+		self.spatial_index = None
+		self.slice_members = None
+		self.slice_offsets = None
+		self.slice_scale = np.ones(3)
+		self.layer_green = None
+		self.layer_red = None
+		self.layer_area = None
+		self.layer_offsets = None
+		self.progress_bar = NoProgress()
+	
+	def open_stack (self, file_path):
+		self.nd2_file = Path(file_path)
+		self.image_stack = self.open_reader(self.nd2_file)
+		self.x_size = self.image_stack.sizes['x']
+		self.y_size = self.image_stack.sizes['y']
+		self.z_size = self.image_stack.sizes['z']
+		self.geo_size = int(min(self.x_size,self.y_size)/8)
+		self.x_lower = 0
+		self.x_upper = self.x_size-1
+		self.y_lower = 0
+		self.y_upper = self.y_size-1
+		self.z_lower = 0
+		self.z_upper = self.z_size-1
+		self.scale[0] = self.image_stack.metadata['pixel_microns']
+		self.scale[1] = self.image_stack.metadata['pixel_microns']
+		self.scale[2] = self.image_stack.metadata['z_coordinates'][1] - \
+						self.image_stack.metadata['z_coordinates'][0]
+	
+	def open_reader (self, file_path):
+		return open_indexed_stack(file_path)
+	
+	def set_parameters (self, parameters):
+		for name in self.parameter_names:
+			if name in parameters:
+				setattr(self, name, parameters[name])
+	
+	def get_parameters (self):
+		parameters = {}
+		for name in self.parameter_names:
+			value = getattr(self, name)
+			if isinstance(value, np.generic):
+				value = value.item()
+			parameters[name] = value
+		return parameters
+	
+	def get_roi (self):
+		return np.array([self.x_lower, self.x_upper,
+						 self.y_lower, self.y_upper,
+						 self.z_lower, self.z_upper], dtype = int)
+	
+	def run (self):
+		self.skipped_slices = 0
+		cache_key = run_key(file_fingerprint(self.nd2_file),
+							self.get_roi(), self.get_parameters())
+		cached_results = None
+		if self.use_cache:
+			cached_results = self.result_cache.get(cache_key)
+		if cached_results is not None:
+			results, _, _, _, extra_arrays = cached_results
+			positions, green_cells, red_cells, epi_cells = \
+							self.restore_results(results, extra_arrays)
+		else:
+			checkpoint = Checkpoint(cache_directory('checkpoints') / cache_key)
+			if not self.resume_run:
+				checkpoint.clear()
+			linked = checkpoint.load('linked')
+			if linked is None:
+				linked = self.correlate_layers(*self.detect_layers(checkpoint))
+				checkpoint.save('linked', **linked)
+			positions = linked['positions']
+			green_cells = linked['green_cells']
+			red_cells = linked['red_cells']
+			self.layer_green = linked['layer_green']
+			self.layer_red = linked['layer_red']
+			self.layer_area = linked['layer_area']
+			self.layer_offsets = linked['layer_offsets']
+			epithelial = checkpoint.load('epithelial')
+			if epithelial is None:
+				epi_cells = self.find_epithelial_cells(positions, green_cells,
+																  red_cells)
+				checkpoint.save('epithelial', epi_cells = epi_cells,
+								**graph_arrays(self.adjacency))
+			else:
+				epi_cells = epithelial['epi_cells']
+				self.adjacency = load_graph(epithelial)
+			self.results = result_table(positions, green_cells, red_cells,
+															epi_cells)
+			self.spatial_index = SpatialIndex(positions)
+		self.slice_offsets = None
+		self.slice_scale = np.array(self.scale, dtype = float)
+		self.progress_bar.setMinimum(0)
+		self.progress_bar.setFormat('')
+		self.progress_bar.setMaximum(1)
+		self.progress_bar.setValue(0)
+		# a cache hit reuses the output files written for the key
+		self.output_files = None
+		if cached_results is not None:
+			self.output_files = self.result_cache.outputs(cache_key)
+		if self.output_files is None:
+			self.output_files = [self.save_csv(self.results),
+								 self.save_npz(self.results)]
+			if self.use_cache:
+				self.result_cache.set_outputs(cache_key, self.output_files)
+		if cached_results is None:
+			if self.use_cache:
+				self.result_cache.put(cache_key, lambda file_path: \
+						self.save_npz(self.results, file_path = file_path))
+			checkpoint.clear()
+		return (self.results.rows()['positions'],) + self.results.cells()
+	
+	def restore_results (self, results, extra_arrays):
+		self.results = ResultTable(rows = results)
+		self.adjacency = load_graph(extra_arrays)
+		self.spatial_index = load_index(results['positions'],
+										extra_arrays)
+		self.slice_offsets = None
+		if 'layer_offsets' in extra_arrays:
+			self.layer_green = extra_arrays['layer_green']
+			self.layer_red = extra_arrays['layer_red']
+			self.layer_area = extra_arrays.get('layer_area')
+			self.layer_offsets = extra_arrays['layer_offsets']
+		else:
+			self.layer_offsets = None
+		return (self.results.rows()['positions'],) + self.results.cells()
+	
+	def build_slice_index (self, scale = None):
+		# a nucleus spans the layers linked into it, which are consecutive
+		# and centred on its position
+		if scale is not None:
+			self.slice_scale = np.asarray(scale, dtype = float)
+		positions = self.results.rows()['positions']
+		z_values = positions[:,2] / self.slice_scale[2]
+		if self.layer_offsets is not None and \
+		   len(self.layer_offsets) == positions.shape[0] + 1:
+			half = (np.diff(self.layer_offsets) - 1) / 2
+		else:
+			half = np.full(positions.shape[0], (self.number_layer_cell-1) / 2)
+		z_size = max(self.z_size, int(np.ceil(np.amax(z_values + half,
+												initial = 0.))) + 1)
+		self.slice_members, self.slice_offsets = slice_index(
+								np.round(z_values - half).astype(np.int64),
+								np.round(z_values + half).astype(np.int64),
+								z_size)
+	
+	def slice_results (self, z_level):
+		# rows of the nuclei spanning the slice, in pixels of the slice
+		if self.slice_offsets is None:
+			self.build_slice_index()
+		if z_level < 0 or z_level >= len(self.slice_offsets) - 1:
+			return np.zeros(0, dtype = result_dtype)
+		rows = self.results.rows()[self.slice_members[
+						self.slice_offsets[z_level]:
+						self.slice_offsets[z_level+1]]]
+		rows['positions'] /= self.slice_scale
+		return rows
+	
+	def region_index (self):
+		if self.spatial_index is None or \
+		   len(self.spatial_index.positions) != len(self.results):
+			self.spatial_index = SpatialIndex(
+									self.results.rows()['positions'])
+		return self.spatial_index
+	
+	def query_region (self, query):
+		# query is ('box', lower, upper), ('radius', centre, radius) or
+		# ('nearest', point, k), the indices of the nuclei found come back
+		kind, first, second = query
+		if kind == 'box':
+			return self.region_index().box(first, second)
+		if kind == 'radius':
+			return self.region_index().radius(first, second)
+		if kind == 'nearest':
+			return self.region_index().nearest(first, int(second))[0]
+		raise ValueError('Unknown query: {0:s}'.format(str(kind)))
+	
+	def neighbour_statistics (self):
+		# neighbour counts and positive neighbour fractions over the pruned
+		# mesh of the last run, None without a mesh
+		if self.adjacency is None or self.results is None:
+			return None
+		green_cells, red_cells, epi_cells = self.results.cells()
+		return {'neighbours': neighbour_counts(self.adjacency),
+				'green_fraction': neighbour_fractions(self.adjacency,
+													  green_cells),
+				'red_fraction': neighbour_fractions(self.adjacency, red_cells),
+				'epi_fraction': neighbour_fractions(self.adjacency, epi_cells)}
+	
+	def detect_layers (self, checkpoint):
+		layers = ResultTable(layer_dtype)
+		z_lower, z_upper = self.z_lower, self.z_upper
+		self.update_dapi_reference()
+		if self.skip_empty:
+			# only the empty runs at the ends are left out, a gap inside the
+			# tissue would break every nucleus linked across it
+			signal = np.flatnonzero(signal_slices(
+							self.scan_slices(list(range(z_lower, z_upper+1))),
+							self.slice_signal))
+			if len(signal) > 0:
+				z_lower, z_upper = z_lower + signal[0], z_lower + signal[-1]
+		z_levels = list(range(z_lower, z_upper+1))
+		self.skipped_slices = self.z_upper+1 - self.z_lower - len(z_levels)
+		self.progress_bar.setRange(self.z_lower, self.z_upper)
+		self.progress_bar.setValue(self.z_lower)
+		self.progress_bar.setFormat('Processing Z-Stack: %p%')
+		for z_level, (dapi_centres, green_values, red_values, areas) in \
+					self.checkpointed_stack(z_levels, checkpoint):
+			layers.append(positions = np.column_stack([
+								dapi_centres + np.array([self.x_lower,
+														 self.y_lower]),
+								np.full(dapi_centres.shape[0], z_level)]),
+						  green = green_values, red = red_values,
+						  area = areas)
+			self.progress_bar.setValue(z_level)
+		self.progress_bar.reset()
+		rows = layers.rows()
+		return rows['positions'], rows['green'], rows['red'], rows['area']
+	
+	def scan_stack (self, name, z_levels, read_slice, measure, shape, dtype,
+						step = 4):
+		# measurements of single slices within the xy bounds, kept in the
+		# cache as parameter changes do not affect them. only the slices of
+		# z_levels that were never scanned are read
+		key = run_key(file_fingerprint(self.nd2_file),
+					  [self.x_lower, self.x_upper, self.y_lower, self.y_upper,
+					   0, self.z_size-1], {'scan': name, 'step': step})
+		path = cache_directory('slices') / (key + '.npz')
+		try:
+			with np.load(str(path)) as scan_file:
+				values = scan_file['values']
+				scanned = scan_file['scanned']
+		except (OSError, ValueError, KeyError):
+			values = np.zeros((self.z_size,) + shape, dtype = dtype)
+			scanned = np.zeros(self.z_size, dtype = bool)
+		missing = [ z_level for z_level in z_levels if not scanned[z_level] ]
+		if len(missing) == 0:
+			return values
+		self.progress_bar.setRange(0, len(missing))
+		self.progress_bar.setFormat('Scanning Slices: %p%')
+		for count, (z_level, measured) in enumerate(
+							self.stream_stack(missing, measure, read_slice)):
+			values[z_level] = measured
+			scanned[z_level] = True
+			self.progress_bar.setValue(count+1)
+		self.progress_bar.reset()
+		partial = partial_path(path)
+		np.savez_compressed(str(partial), values = values, scanned = scanned)
+		os.replace(str(partial), str(path))
+		return values
+	
+	def scan_levels (self):
+		# the z bounds, or the whole stack without bounds
+		if self.z_upper > self.z_lower:
+			return list(range(self.z_lower, self.z_upper+1))
+		return list(range(self.z_size))
+	
+	def scan_slices (self, z_levels, step = 4):
+		# statistics of the DAPI channel alone
+		def measure (frame):
+			return slice_statistics(frame[self.y_lower:self.y_upper,
+										  self.x_lower:self.x_upper], step)
+		return self.scan_stack('statistics', z_levels,
+							   lambda z_level: self.read_channel(z_level,
+																 'DAPI'),
+							   measure, (4,), float, step)[z_levels]
+	
+	def stack_histograms (self, step = 4):
+		# summed over the slices of the z bounds
+		def measure (frames):
+			return channel_histograms([ frame[self.y_lower:self.y_upper,
+											  self.x_lower:self.x_upper]
+										for frame in frames ], step)
+		z_levels = self.scan_levels()
+		histograms = self.scan_stack('histograms', z_levels,
+									 self.read_frames, measure,
+									 (3, histogram_bins), np.uint32, step)
+		return histograms[z_levels].sum(axis = 0, dtype = np.int64)
+	
+	def suggest_thresholds (self):
+		# slider ranges from the brightest pixels, lower thresholds from
+		# Otsu's method and upper thresholds from the top percentile
+		_, green_histogram, red_histogram = self.stack_histograms()
+		suggestions = {}
+		for name, histogram in [('green', green_histogram),
+								('red', red_histogram)]:
+			if histogram.sum() == 0:
+				continue
+			top = (int(np.flatnonzero(histogram)[-1]) + 1) << histogram_shift
+			suggestions[name + '_max'] = top - 1
+			suggestions[name + '_lower'] = otsu_threshold(histogram)
+			suggestions[name + '_upper'] = max(suggestions[name + '_lower'],
+									histogram_percentile(histogram, 0.995))
+		return suggestions
+	
+	def update_dapi_reference (self):
+		# the stack wide intensity range replaces the range of each slice
+		# in the outside filter of find_centres
+		self.dapi_reference = None
+		if self.stack_reference:
+			dapi_histogram = self.stack_histograms()[0]
+			self.dapi_reference = (
+						histogram_percentile(dapi_histogram, 0.005),
+						histogram_percentile(dapi_histogram, 0.999))
+	
+	def suggest_z_bounds (self):
+		# always over the whole stack, the z bounds are what it suggests
+		signal = np.flatnonzero(signal_slices(
+								self.scan_slices(list(range(self.z_size))),
+								self.slice_signal))
+		if len(signal) == 0:
+			return self.z_lower, self.z_upper, 0
+		return signal[0], signal[-1], \
+			   self.z_size - (signal[-1] - signal[0] + 1)
+	
+	def checkpointed_stack (self, z_levels, checkpoint):
+		# slices stored by an interrupted run are loaded, the others are
+		# processed and stored as they come in
+		missing = [ z_level for z_level in z_levels
+						if not checkpoint.exists(slice_name(z_level)) ]
+		processed = self.stream_stack(missing, self.measure_frames)
+		try:
+			for z_level in z_levels:
+				if z_level in missing:
+					_, (dapi_centres, green_values, red_values, areas) = \
+															next(processed)
+					checkpoint.save(slice_name(z_level),
+									dapi_centres = dapi_centres,
+									green_values = green_values,
+									red_values = red_values,
+									areas = areas)
+				else:
+					detections = checkpoint.load(slice_name(z_level))
+					dapi_centres = detections['dapi_centres']
+					green_values = detections['green_values']
+					red_values = detections['red_values']
+					areas = detections['areas']
+				yield z_level, (dapi_centres, green_values, red_values, areas)
+		finally:
+			processed.close()
+	
+	def correlate_layers (self, positions_layer, green_values_layer,
+											red_values_layer, areas_layer):
+		green_cells_layer, red_cells_layer = self.classify_cells(
+										green_values_layer, red_values_layer)
+		self.progress_bar.setRange(0, 0)
+		self.progress_bar.setFormat('Correlating Layers')
+		members, offsets = link_layers(positions_layer, self.minimum_distance)
+		counts = np.diff(offsets)
+		linked = (counts >= self.number_layer_cell)
+		members = members[np.repeat(linked, counts)]
+		layer_offsets = np.append(0, np.cumsum(counts[linked]))
+		nucleus = np.repeat(np.arange(np.count_nonzero(linked)),
+							counts[linked])
+		positions = np.vstack([np.bincount(nucleus,
+									weights = positions_layer[members,axis],
+									minlength = np.count_nonzero(linked))
+								for axis in range(3)]).T / \
+									counts[linked][:,np.newaxis]
+		self.progress_bar.reset()
+		return {'positions': positions * self.scale,
+				'green_cells': vote_cells(green_cells_layer[members],
+										  layer_offsets),
+				'red_cells': vote_cells(red_cells_layer[members],
+										layer_offsets),
+				'layer_green': green_values_layer[members],
+				'layer_red': red_values_layer[members],
+				'layer_area': areas_layer[members],
+				'layer_offsets': layer_offsets}
+	
+	def find_epithelial_cells (self, positions, green_cells, red_cells):
+		epi_cells = np.zeros(len(red_cells), dtype = bool)
+		self.adjacency = None
+		self.progress_bar.reset()
+		if self.geometry_active and self.geo_engine == 'voxel':
+			self.progress_bar.setRange(0, 0)
+			self.progress_bar.setFormat('Finding Epithelial Cells')
+			epi_cells = self.voxel_epithelial_cells(positions, red_cells)
+			self.progress_bar.reset()
+		elif self.geometry_active:
+			from scipy.spatial import Delaunay
+			from trimesh import Trimesh
+			from trimesh.repair import fix_normals
+			from trimesh.graph import connected_components
+			self.progress_bar.setMinimum(0)
+			self.progress_bar.setMaximum(positions.shape[0])
+			self.progress_bar.setValue(0)
+			self.progress_bar.setFormat('Finding Epithelial Cells: %p%')
+			if self.geo_chunked:
+				mesh_3d = chunked_triangulation(positions, self.geo_edge_max)
+			else:
+				triangulation = Delaunay(positions)
+				mesh_3d = SimplicialComplex(triangulation.points,
+											triangulation.simplices,
+											triangulation.neighbors)
+			mesh_3d.remove_long_simplices(self.geo_edge_max)
+			self.adjacency = adjacency_matrix(mesh_3d.edges(),
+											  positions.shape[0])
+			faces_all, faces_is_outer = mesh_3d.facets()
+			faces_outer = faces_all[faces_is_outer]
+			outer_points_indices = np.unique(faces_outer)
+			points = positions[outer_points_indices]
+			outer_points_dict = np.zeros(positions.shape[0], dtype = int)
+			outer_points_dict[outer_points_indices] = np.arange(
+													len(outer_points_indices))
+			faces = outer_points_dict[faces_outer]
+			points_red = red_cells[outer_points_indices]
+			faces_red = (points_red[faces[:,0]] & points_red[faces[:,1]]) | \
+						(points_red[faces[:,0]] & points_red[faces[:,2]]) | \
+						(points_red[faces[:,1]] & points_red[faces[:,2]])
+			points_green = green_cells[outer_points_indices]
+			faces_green = (points_green[faces[:,0]] & \
+								points_green[faces[:,1]]) | \
+						  (points_green[faces[:,0]] & \
+								points_green[faces[:,2]]) | \
+						  (points_green[faces[:,1]] & \
+								points_green[faces[:,2]])
+			faces_purple = faces_red & faces_green
+			surface_mesh = Trimesh(vertices = points, faces = faces)
+			if self.nd2_file is not None:
+				surface_mesh.export(self.nd2_file.with_suffix(
+					'.{0:s}.stl'.format(time.strftime("%Y.%m.%d-%H.%M.%S"))))
+			fix_normals(surface_mesh)
+			mask = np.zeros(faces.shape[0], dtype = bool)
+			if self.x_lower > 0:
+				mask = mask | \
+					((points[faces[:,0],0] < (self.x_lower + \
+									self.geo_edge_max/3) * self.scale[0]) & \
+					 (points[faces[:,1],0] < (self.x_lower + \
+									self.geo_edge_max/3) * self.scale[0]) & \
+					 (points[faces[:,2],0] < (self.x_lower + \
+									self.geo_edge_max/3) * self.scale[0]) & \
+					 (np.abs(surface_mesh.face_normals[:,0]) > 0.7))
+			if self.y_lower > 0:
+				mask = mask | \
+					((points[faces[:,0],1] < (self.y_lower + \
+									self.geo_edge_max/3) * self.scale[0]) & \
+					 (points[faces[:,1],1] < (self.y_lower + \
+									self.geo_edge_max/3) * self.scale[0]) & \
+					 (points[faces[:,2],1] < (self.y_lower + \
+									self.geo_edge_max/3) * self.scale[0]) & \
+					 (np.abs(surface_mesh.face_normals[:,1]) > 0.7))
+			if self.z_lower > 0:
+				mask = mask | \
+					((points[faces[:,0],2] < (self.z_lower + \
+									self.geo_edge_max/3) * self.scale[0]) & \
+					 (points[faces[:,1],2] < (self.z_lower + \
+									self.geo_edge_max/3) * self.scale[0]) & \
+					 (points[faces[:,2],2] < (self.z_lower + \
+									self.geo_edge_max/3) * self.scale[0]) & \
+					 (np.abs(surface_mesh.face_normals[:,2]) > 0.7))
+			if self.x_upper < self.x_size-1:
+				mask = mask | \
+					((points[faces[:,0],0] > (self.x_upper - \
+									self.geo_edge_max/3) * self.scale[0]) & \
+					 (points[faces[:,1],0] > (self.x_upper - \
+									self.geo_edge_max/3) * self.scale[0]) & \
+					 (points[faces[:,2],0] > (self.x_upper - \
+									self.geo_edge_max/3) * self.scale[0]) & \
+					 (np.abs(surface_mesh.face_normals[:,0]) > 0.7))
+			if self.y_upper < self.y_size-1:
+				mask = mask | \
+					((points[faces[:,0],1] > (self.y_upper - \
+									self.geo_edge_max/3) * self.scale[0]) & \
+					 (points[faces[:,1],1] > (self.y_upper - \
+									self.geo_edge_max/3) * self.scale[0]) & \
+					 (points[faces[:,2],1] > (self.y_upper - \
+									self.geo_edge_max/3) * self.scale[0]) & \
+					 (np.abs(surface_mesh.face_normals[:,1]) > 0.7))
+			if self.z_upper < self.z_size-1:
+				mask = mask | \
+					((points[faces[:,0],2] > (self.z_upper - \
+									self.geo_edge_max/3) * self.scale[0]) & \
+					 (points[faces[:,1],2] > (self.z_upper - \
+									self.geo_edge_max/3) * self.scale[0]) & \
+					 (points[faces[:,2],2] > (self.z_upper - \
+									self.geo_edge_max/3) * self.scale[0]) & \
+					 (np.abs(surface_mesh.face_normals[:,2]) > 0.7))
+			surface_mesh.update_faces(np.logical_not(mask))
+			fix_normals(surface_mesh)
+			mask = np.zeros(len(surface_mesh.faces), dtype = bool)
+			cc = connected_components(surface_mesh.face_adjacency, min_len=4)
+			mask[np.concatenate(cc)] = True
+			surface_mesh.update_faces(mask)
+			#surface_mesh.show()
+			#closest_points, distances, triangle_ids = \
+			#		surface_mesh.nearest.on_surface(positions)
+			for index, point in enumerate(positions):
+				closest_point, distance, triangle_id = \
+						surface_mesh.nearest.on_surface([point])
+				epi_cells[index] = ((distance[0] < self.geo_dist_red * \
+													self.scale[0]) and \
+												faces_red[triangle_id[0]]) | \
+								   ((distance[0] < self.geo_distance * \
+													self.scale[0]) and \
+											not faces_red[triangle_id[0]])
+				self.progress_bar.setValue(index)
+			###############################################################
+			#face_colors = np.ones((faces.shape[0],  4), dtype = int)*150
+			#face_colors[:,3] = 255
+			#face_colors[faces_red] = [[200,0,0,255]]
+			#face_colors[faces_green] = [[0,200,0,255]]
+			#face_colors[faces_purple] = [[120,0,120,255]]
+			#surface_mesh.visual.face_colors = face_colors
+			#surface_mesh.show(smooth=False)
+			###############################################################
+			self.progress_bar.reset()
+			#
+		return epi_cells
+	
+	def voxel_epithelial_cells (self, positions, red_cells):
+		spacing = np.array([max(self.scale[0],
+								self.geo_dist_red*self.scale[0]/2),
+							max(self.scale[1],
+								self.geo_dist_red*self.scale[1]/2),
+							self.scale[2]])
+		bounds = np.array([[self.x_lower, self.x_upper],
+						   [self.y_lower, self.y_upper],
+						   [self.z_lower, self.z_upper]]) * \
+														self.scale[:,np.newaxis]
+		open_sides = np.array([[self.x_lower > 0, self.x_upper < self.x_size-1],
+							   [self.y_lower > 0, self.y_upper < self.y_size-1],
+							   [self.z_lower > 0, self.z_upper < self.z_size-1]])
+		distances, closest_is_red = voxel_surface_distances(positions,
+										red_cells, spacing, self.geo_edge_max/2,
+										bounds, open_sides)
+		return ((distances < self.geo_dist_red * self.scale[0]) & \
+													closest_is_red) | \
+			   ((distances < self.geo_distance * self.scale[0]) & \
+											np.logical_not(closest_is_red))
+	
+	def save_csv (self, results):
+		output_array = np.column_stack((results.rows()['positions'],) + \
+														results.cells())
+		data_format = '%.18e', '%.18e', '%.18e', '%1d', '%1d', '%1d'
+		file_path = self.nd2_file.with_suffix(
+				'.{0:s}.csv'.format(time.strftime("%Y.%m.%d-%H.%M.%S")))
+		np.savetxt(file_path, output_array, fmt = data_format, delimiter = ',',
+				header = 'X,Y,Z,Is_Green,Is_Red,Is_Epithellial')
+		return file_path
+	
+	def save_npz (self, results, file_path = None):
+		if file_path is None:
+			file_path = self.nd2_file.with_suffix(
+				'.{0:s}.npz'.format(time.strftime("%Y.%m.%d-%H.%M.%S")))
+		save_results(file_path, results,
+				parameters = self.get_parameters(), scale = self.scale,
+				roi = self.get_roi(),
+				layer_green = self.layer_green, layer_red = self.layer_red,
+				layer_area = self.layer_area,
+				layer_offsets = self.layer_offsets,
+				**graph_arrays(self.adjacency), **self.region_index().arrays())
+		return file_path
+	
+	def read_frames (self, z_value):
+		dapi_image = np.zeros((0,2))
+		green_image = np.zeros((0,2))
+		red_image = np.zeros((0,2))
+		channels = self.image_stack.metadata['channels']
+		for index, channel in enumerate(channels):
+			if channel == 'DAPI':
+				dapi_image = self.image_stack.get_frame_2D(
+									c = index,
+									z = z_value)
+			elif channel == 'Green':
+				green_image = self.image_stack.get_frame_2D(
+									c = index,
+									z = z_value)
+			elif channel == 'Red':
+				red_image = self.image_stack.get_frame_2D(
+									c = index,
+									z = z_value)
+		return dapi_image, green_image, red_image
+	
+	def read_channel (self, z_value, name):
+		channels = self.image_stack.metadata['channels']
+		if name not in channels:
+			return np.zeros((0,2))
+		return self.image_stack.get_frame_2D(c = channels.index(name),
+											 z = z_value)
+	
+	def stream_stack (self, z_levels, work, read_slice = None):
+		# a reader thread decodes the frames and hands them to the workers,
+		# at most queue_depth frames are in flight and results come back in
+		# z order as soon as they are ready
+		if read_slice is None:
+			read_slice = self.read_frames
+		slots = threading.Semaphore(self.queue_depth)
+		futures = queue.Queue()
+		stop = threading.Event()
+		with ThreadPoolExecutor(max_workers = self.workers) as pool:
+			def read ():
+				try:
+					for z_level in z_levels:
+						while not slots.acquire(timeout = 0.1):
+							if stop.is_set():
+								return
+						if stop.is_set():
+							return
+						future = pool.submit(work, read_slice(z_level))
+						future.add_done_callback(lambda _: slots.release())
+						futures.put((z_level, future))
+				except Exception as error:
+					futures.put((None, error))
+				futures.put(None)
+			reader = threading.Thread(target = read, daemon = True)
+			reader.start()
+			try:
+				while True:
+					item = futures.get()
+					if item is None:
+						break
+					z_level, future = item
+					if z_level is None:
+						raise future
+					yield z_level, future.result()
+			finally:
+				stop.set()
+				reader.join()
+	
+	def measure_frames (self, frames):
+		dapi_image, green_image, red_image = frames
+		if not self.green_active:
+			green_image = None
+		if not self.red_active:
+			red_image = None
+		return self.measure_image(dapi_image, green_image, red_image)
+	
+	def preview_slice (self, frames, factor = 1, display_size = 512):
+		dapi_image, green_image, red_image = frames
+		if not self.green_active:
+			green_image = None
+		if not self.red_active:
+			red_image = None
+		if factor > 1:
+			dapi_centres, green_cells, red_cells = self.process_binned(
+							dapi_image, green_image, red_image, factor)
+		else:
+			dapi_centres, green_cells, red_cells = self.process_image(
+							dapi_image, green_image, red_image)
+		frame = dapi_image[self.y_lower:self.y_upper,
+						   self.x_lower:self.x_upper]
+		step = max(1, max(frame.shape) // display_size)
+		return frame[::step,::step], dapi_centres, green_cells, red_cells
+	
+	def preview_strip (self, count = 9, factor = 1):
+		# detection on count z levels spread over the z bounds, run
+		# concurrently on the worker pool
+		z_lower, z_upper = self.z_lower, self.z_upper
+		if z_upper <= z_lower:
+			z_lower, z_upper = 0, self.z_size-1
+		z_levels = np.unique(np.linspace(z_lower, z_upper,
+										 count).round().astype(int))
+		strip = []
+		self.progress_bar.setRange(0, len(z_levels))
+		self.progress_bar.setValue(0)
+		self.progress_bar.setFormat('Previewing Slices: %p%')
+		for z_level, preview in self.stream_stack(z_levels,
+							lambda frames: self.preview_slice(frames, factor)):
+			strip.append((z_level,) + preview)
+			self.progress_bar.setValue(len(strip))
+		self.progress_bar.reset()
+		return strip
+	
+	def process_image (self, dapi_image, green_image = None,
+										red_image = None):
+		dapi_centres, green_values, red_values, _ = self.measure_image(
+										dapi_image, green_image, red_image)
+		green_cells, red_cells = self.classify_cells(green_values, red_values)
+		return dapi_centres, green_cells, red_cells
+	
+	def process_binned (self, dapi_image, green_image = None,
+										red_image = None, factor = 2):
+		# detection on frames binned by factor with the lengths scaled to
+		# match, the centres are mapped back to full resolution
+		binned = Pipeline()
+		binned.set_parameters(self.get_parameters())
+		binned.x_lower = self.x_lower // factor
+		binned.x_upper = self.x_upper // factor
+		binned.y_lower = self.y_lower // factor
+		binned.y_upper = self.y_upper // factor
+		binned.neighbourhood_size = max(3, int(round(
+										self.neighbourhood_size / factor)))
+		binned.gauss_deviation = self.gauss_deviation / factor
+		binned.dapi_reference = self.dapi_reference
+		if green_image is not None:
+			green_image = bin_frame(green_image, factor)
+		if red_image is not None:
+			red_image = bin_frame(red_image, factor)
+		dapi_centres, green_cells, red_cells = binned.process_image(
+						bin_frame(dapi_image, factor), green_image, red_image)
+		dapi_centres = (dapi_centres + np.array([binned.x_lower,
+												 binned.y_lower])) * factor + \
+						factor // 2 - np.array([self.x_lower, self.y_lower])
+		return dapi_centres, green_cells, red_cells
+	
+	def measure_image (self, dapi_image, green_image = None,
+										red_image = None):
+		import mahotas as mh
+		dapi_centres = self.find_centres(dapi_image)
+		delta = self.neighbourhood_size # int(self.neighbourhood_size/2)
+		green_values = np.full(dapi_centres.shape[0], np.nan)
+		if green_image is not None:
+			green_blur = green_image[self.y_lower:self.y_upper,
+									 self.x_lower:self.x_upper]
+			if self.low_memory:
+				green_blur = blur_frame(green_blur, self.gauss_deviation,
+										'green_blur')
+			else:
+				green_blur = mh.gaussian_filter(green_blur,
+												self.gauss_deviation)
+			#	green_blur = np.where(green_blur > self.green_lower,
+			#					np.where(green_blur < self.green_upper,
+			#								green_blur, self.green_upper), 0)
+		red_values = np.full(dapi_centres.shape[0], np.nan)
+		if red_image is not None:
+			red_blur = red_image[self.y_lower:self.y_upper,
+								 self.x_lower:self.x_upper]
+			if self.low_memory:
+				red_blur = blur_frame(red_blur, self.gauss_deviation,
+									  'red_blur')
+			else:
+				red_blur = mh.gaussian_filter(red_blur, self.gauss_deviation)
+			#	red_blur = np.where(red_blur > self.red_lower,
+			#					np.where(red_blur < self.red_upper,
+			#								red_blur, self.red_upper), 0)
+		# median seems to work better than mean. the medians are kept
+		# unclipped, classify_cells clips them at the upper limits
+		areas = np.full(dapi_centres.shape[0], np.nan)
+		if self.segmentation == 'watershed':
+			labels = self.segment_nuclei(dapi_image, dapi_centres)
+			areas = np.bincount(labels.ravel(),
+						minlength = dapi_centres.shape[0]+1)[1:].astype(float)
+			if green_image is not None:
+				green_values = label_medians(green_blur, labels,
+											 dapi_centres.shape[0])
+			if red_image is not None:
+				red_values = label_medians(red_blur, labels,
+										   dapi_centres.shape[0])
+			return dapi_centres, green_values, red_values, areas
+		if green_image is not None:
+			green_values = window_medians(green_blur, dapi_centres, delta)
+		if red_image is not None:
+			red_values = window_medians(red_blur, dapi_centres, delta)
+		return dapi_centres, green_values, red_values, areas
+	
+	def segment_nuclei (self, dapi_image, centres):
+		# watershed of the blurred DAPI from the centres, each nucleus is
+		# cut off where it drops below half of its peak
+		import mahotas as mh
+		frame = dapi_image[self.y_lower:self.y_upper,
+						   self.x_lower:self.x_upper]
+		if self.low_memory:
+			frame = blur_frame(frame, self.gauss_deviation, 'dapi_segment')
+		else:
+			frame = mh.gaussian_filter(frame, self.gauss_deviation)
+		markers = np.zeros(frame.shape, dtype = np.int32)
+		markers[centres[:,1],centres[:,0]] = np.arange(1, centres.shape[0]+1)
+		labels = mh.cwatershed(np.amax(frame) - frame, markers)
+		minimum, _ = self.intensity_range(frame)
+		peaks = frame[centres[:,1],centres[:,0]]
+		levels = np.append(np.inf, (peaks + minimum) / 2)
+		labels[frame < levels[labels]] = 0
+		return labels
+	
+	def classify_cells (self, green_values, red_values):
+		# inactive channels are measured as nan, which never passes a threshold
+		green_values = np.minimum(green_values, self.green_upper)
+		red_values = np.minimum(red_values, self.red_upper)
+		green_cells = (green_values > self.green_lower)
+		red_cells = (red_values > self.red_lower)
+		if self.green_cutoff_active:
+			red_cells[green_values > self.green_cutoff] = False
+		if self.red_cutoff_active:
+			green_cells[red_values > self.red_cutoff] = False
+		return green_cells, red_cells
+	
+	def find_centres (self, image):
+		from scipy import ndimage as ndi
+		frame = image[self.y_lower:self.y_upper,
+					  self.x_lower:self.x_upper]
+		maxima = self.find_maxima(frame)
+		labeled, num_objects = ndi.label(maxima)
+		slices = ndi.find_objects(labeled)
+		centres = np.zeros((len(slices),2), dtype = int)
+		good_centres = 0
+		for (dy,dx) in slices:
+			centres[good_centres,0] = int((dx.start + dx.stop - 1)/2)
+			centres[good_centres,1] = int((dy.start + dy.stop - 1)/2)
+			if centres[good_centres,0] < self.neighbourhood_size/2 or \
+			   centres[good_centres,0] > (self.x_upper-self.x_lower) - \
+			   								self.neighbourhood_size/2 or \
+			   centres[good_centres,1] < self.neighbourhood_size/2 or \
+			   centres[good_centres,1] > (self.y_upper-self.y_lower) - \
+			   								self.neighbourhood_size/2:
+				good_centres -= 1
+			good_centres += 1
+		centres = centres[:good_centres]
+		return centres
+	
+	def find_maxima (self, frame):
+		# every detector returns a mask of the maxima in the frame, connected
+		# maxima are merged into one centre by find_centres
+		if self.detector == 'dog':
+			return self.find_maxima_dog(frame)
+		if self.low_memory:
+			return self.find_maxima_low_memory(frame)
+		return self.find_maxima_filter(frame)
+	
+	def find_maxima_filter (self, frame):
+		from scipy import ndimage as ndi
+		import mahotas as mh
+		frame = mh.gaussian_filter(frame, self.gauss_deviation)
+		frame_max = ndi.maximum_filter(frame, self.neighbourhood_size)
+		maxima = (frame == frame_max)
+		frame_min = ndi.minimum_filter(frame, self.neighbourhood_size)
+		differences = ((frame_max - frame_min) > self.threshold_difference)
+		maxima[differences == 0] = 0
+		minimum, maximum = self.intensity_range(frame)
+		outside_filter = (frame_max > (maximum-minimum)*0.1 + minimum)
+		maxima[outside_filter == 0] = 0
+		return maxima
+	
+	def find_maxima_dog (self, frame):
+		# blobs from gauss_deviation up to half the neighbourhood size, the
+		# strongest response within a neighbourhood is kept
+		from scipy import ndimage as ndi
+		blobs = dog_blobs(frame, max(1., self.gauss_deviation),
+						  max(1., self.gauss_deviation,
+							  self.neighbourhood_size / 2))
+		minimum, maximum = self.intensity_range(blobs['base'])
+		keep = (blobs['responses'] > self.threshold_difference) & \
+			   (blobs['values'] > (maximum-minimum)*0.1 + minimum)
+		response = np.zeros(frame.shape, dtype = np.float32)
+		np.maximum.at(response, (blobs['positions'][keep,1],
+								 blobs['positions'][keep,0]),
+					  blobs['responses'][keep])
+		maxima = (response == ndi.maximum_filter(response,
+												 self.neighbourhood_size))
+		maxima &= (response > 0)
+		return maxima
+	
+	def intensity_range (self, frame):
+		if self.dapi_reference is not None:
+			return self.dapi_reference
+		return np.amin(frame), np.amax(frame)
+	
+	def find_maxima_low_memory (self, frame):
+		# same filters as find_centres, in float32 and into reused buffers
+		from scipy import ndimage as ndi
+		shape = frame.shape
+		frame = blur_frame(frame, self.gauss_deviation, 'dapi_blur')
+		frame_max = ndi.maximum_filter(frame, self.neighbourhood_size,
+									output = frame_buffer('dapi_max', shape))
+		frame_min = ndi.minimum_filter(frame, self.neighbourhood_size,
+									output = frame_buffer('dapi_min', shape))
+		maxima = np.equal(frame, frame_max,
+							out = frame_buffer('maxima', shape, bool))
+		mask = frame_buffer('mask', shape, bool)
+		differences = np.subtract(frame_max, frame_min, out = frame_min)
+		maxima &= np.greater(differences, self.threshold_difference,
+															out = mask)
+		minimum, maximum = self.intensity_range(frame)
+		maxima &= np.greater(frame_max, (maximum-minimum)*0.1 + minimum,
+															out = mask)
+		return maxima
+
+################################################################################
+# EOF
@@ -1,39 +1,41 @@
 #!/usr/bin/env /usr/bin/python3
 
-import sys
 import time
+# taken before the other imports so that --profile-startup counts them
+startup_time = time.perf_counter()
+
+import sys
 import numpy as np
 import matplotlib
 matplotlib.use('Qt5Agg')
-from matplotlib import pyplot as plt
 from matplotlib.backends.backend_qt5agg import (
 							FigureCanvasQTAgg as FigureCanvas,
 							NavigationToolbar2QT as NavigationToolbar
 							)
 from matplotlib.figure import Figure
-from matplotlib.colors import LinearSegmentedColormap
-from matplotlib import colors, ticker, cm
-from matplotlib.collections import LineCollection
-from mpl_toolkits.mplot3d.axes3d import Axes3D
-from PIL import Image
-from scipy import ndimage as ndi
-from scipy.spatial import Delaunay, Voronoi, ConvexHull
-from trimesh import Trimesh
-from trimesh.repair import fix_normals
-from trimesh.graph import connected_components
-from trimesh.smoothing import filter_humphrey
-import mahotas as mh
-from PyQt5.QtCore import Qt, QPoint, QRect, QSize
+from PyQt5.QtCore import Qt, QPoint, QRect, QSize, QTimer
 from PyQt5.QtGui import QIntValidator, QMouseEvent
 from PyQt5.QtWidgets import (
 							QApplication, QLabel, QWidget,
 							QPushButton, QHBoxLayout, QVBoxLayout,
 							QComboBox, QCheckBox, QSlider, QProgressBar,
 							QFormLayout, QLineEdit, QTabWidget,
-							QSizePolicy, QFileDialog, QMessageBox
+							QSizePolicy, QFileDialog, QMessageBox,
+							QInputDialog
 							)
 from pathlib import Path
-from nd2reader import ND2Reader
+from ND2_Kernels import nearest_segments
+from ND2_Pipeline import (
+							Pipeline, SimplicialComplex, ResultTable,
+							result_table, result_dtype, edge_dtype,
+							pack_flags, unpack_flags, vote_cells,
+							load_results, save_profile,
+							FLAG_GREEN, FLAG_RED,
+							EDGE_OUTER, EDGE_RED, EDGE_GREEN
+							)
+
+# pyplot, scipy, trimesh, mahotas and nd2reader are imported where they are
+# first used, so that the window comes up without loading them
 
 ################################################################################
 # colormaps for matplotlib #
@@ -53,9 +55,6 @@ red_cdict = {
 				  (1, 1.0, 1.0)),
 		}
 
-red_cmap = LinearSegmentedColormap('red_cmap', red_cdict)
-cm.register_cmap(cmap=red_cmap)
-
 green_cdict = {
 		'red':   ((0, 0.0, 0.0),
 				  (1, 0.0, 0.0)),
@@ -70,9 +69,6 @@ green_cdict = {
 				  (1, 1.0, 1.0)),
 		}
 
-green_cmap = LinearSegmentedColormap('green_cmap', green_cdict)
-cm.register_cmap(cmap=green_cmap)
-
 transparent_cdict = {
 		'red':   ((0, 0.0, 0.0),
 				  (1, 1.0, 1.0)),
@@ -87,66 +83,47 @@ transparent_cdict = {
 				  (1, 0.0, 0.0)),
 		}
 
-transparent_cmap = LinearSegmentedColormap('transparent_cmap',
-											transparent_cdict)
-cm.register_cmap(cmap=transparent_cmap)
+colormap_dicts = {'red_cmap': red_cdict,
+				  'green_cmap': green_cdict,
+				  'transparent_cmap': transparent_cdict}
+colormap_store = {}
 
+def colormap (name):
+	if name not in colormap_store:
+		from matplotlib.colors import LinearSegmentedColormap
+		colormap_store[name] = LinearSegmentedColormap(name,
+													colormap_dicts[name])
+	return colormap_store[name]
 ################################################################################
-# class for triangulation #
-###########################
+# subsampling of point clouds for drawing while the view moves #
+################################################################
 
-class SimplicialComplex ():
-	def __init__ (self, points = None,
-						simplices = None,
-						neighbours = None):
-		self.points = points
-		self.simplices = simplices
-		self.neighbours = neighbours
-		self.longest_edges = None
-		if simplices is not None:
-			self.calc_longest_edges()
-	
-	def calc_longest_edges (self):
-	#	self.longest_edges = np.array(self.simplices.shape[0], dtype = float)
-		point_array = self.points[self.simplices]
-		self.longest_edges = np.amax(np.linalg.norm(
-						point_array[:,np.newaxis,:,:] - \
-						point_array[:,:,np.newaxis,:],
-							axis=-1),axis=(1,2))
-	
-	def remove_simplex (self, index):
-		self.neighbours[self.neighbours == index] = -1
-		self.neighbours[self.neighbours > index] -= 1
-		self.simplices = np.delete(self.simplices, index, axis=0)
-		self.longest_edges = np.delete(self.longest_edges, index)
-	
-	def remove_long_simplices (self, length):
-		for index in np.arange(self.simplices.shape[0]-1,-1,-1):
-			if self.longest_edges[index] > length:
-				self.remove_simplex(index)
-
-################################################################################
-# function to quickly calclate shortest distance to line segment #
-##################################################################
-
-def lineseg_dists(p, a, b):
-	# Handle case where p is a single point, i.e. 1d array.
-	p = np.atleast_2d(p)
-	# possibly faster norms with numba
-	if np.all(a == b):
-		return np.linalg.norm(p - a, axis=1)
-	# normalized tangent vector
-	d = np.divide(b - a, np.linalg.norm(b - a))
-	# signed parallel distance components
-	s = np.dot(a - p, d)
-	t = np.dot(p - b, d)
-	# clamped parallel distance
-	h = np.maximum.reduce([s, t, np.zeros(len(p))])
-	# perpendicular distance component, as before
-	# note that for the 3D case these will be vectors
-	c = np.cross(p - a, d)
-	# use hypot for Pythagoras to improve accuracy
-	return np.hypot(h, c)
+def voxel_subsample (positions, target, seed = 0):
+	# every occupied voxel keeps its share of target points, at least one,
+	# drawn at random so that each category keeps its proportion; the voxels
+	# are sized so that a quarter of target of them are occupied
+	keep = np.zeros(positions.shape[0], dtype = bool)
+	if positions.shape[0] <= target:
+		keep[:] = True
+		return keep
+	lower = np.amin(positions, axis=0)
+	extent = np.maximum(np.ptp(positions, axis=0), 1e-6)
+	cell = np.cbrt(np.prod(extent) / (target/4))
+	while True:
+		voxels = np.floor((positions - lower) / cell).astype(np.int64)
+		keys = np.ravel_multi_index(tuple(voxels.T),
+									tuple(np.amax(voxels, axis=0) + 1))
+		shuffle = np.random.default_rng(seed).permutation(len(keys))
+		order = shuffle[np.argsort(keys[shuffle], kind = 'stable')]
+		_, starts, counts = np.unique(keys[order], return_index = True,
+									  return_counts = True)
+		if len(counts) <= target/4:
+			break
+		cell *= 1.25
+	ranks = np.arange(len(keys)) - np.repeat(starts, counts)
+	quotas = np.ceil(counts * (target / len(keys))).astype(np.int64)
+	keep[order[ranks < np.repeat(quotas, counts)]] = True
+	return keep
 
 ################################################################################
 # canvas widget to put matplotlib plot #
@@ -176,14 +153,9 @@ class MPLCanvas(FigureCanvas):
 		self.show_box = False
 		self.show_mesh = False
 		self.select_box = None
-		self.dapi_centres = np.zeros((0,2), dtype = float)
-		self.green_cells = np.zeros((0,1), dtype = bool)
-		self.red_cells = np.zeros((0,1), dtype = bool)
-		self.epi_cells = np.zeros((0,1), dtype = bool)
-		self.edges = np.zeros((0,2), dtype = int)
-		self.edges_outer = np.zeros((0,1), dtype = bool)
-		self.edges_outer_red = np.zeros((0,1), dtype = bool)
-		self.edges_outer_green = np.zeros((0,1), dtype = bool)
+		self.centres = ResultTable(result_dtype)
+		self.edges = ResultTable(edge_dtype)
+		self.offset = np.zeros(2)
 		self.dapi_centres_plot = None
 		self.green_centres_plot = None
 		self.red_centres_plot = None
@@ -209,18 +181,10 @@ class MPLCanvas(FigureCanvas):
 		self.show_mesh = show_mesh
 		self.plot()
 	
-	def update_centres (self, dapi_centres,
-							green_cells = None, red_cells = None,
-							epi_cells = None, edges = None, edges_outer = None,
-							edges_outer_red = None, edges_outer_green = None):
-		self.dapi_centres = dapi_centres
-		self.green_cells = green_cells
-		self.red_cells = red_cells
-		self.epi_cells = epi_cells
+	def update_centres (self, centres, edges, offset = np.zeros(2)):
+		self.centres = centres
 		self.edges = edges
-		self.edges_outer = edges_outer
-		self.edges_outer_red = edges_outer_red
-		self.edges_outer_green = edges_outer_green
+		self.offset = offset
 		self.plot()
 	
 	def plot (self):
@@ -233,13 +197,16 @@ class MPLCanvas(FigureCanvas):
 		# plots
 		self.ax.set_xlim(left = 0, right = len(self.dapi_image[0,:]))
 		self.ax.set_ylim(bottom = 0, top = len(self.dapi_image[:,0]))
-		self.dapi_plot = self.ax.imshow(self.dapi_image ,cmap=transparent_cmap)
+		self.dapi_plot = self.ax.imshow(self.dapi_image,
+										cmap=colormap('transparent_cmap'))
 		if self.show_green:
-			self.green_plot = self.ax.imshow(self.green_image ,cmap=green_cmap)
+			self.green_plot = self.ax.imshow(self.green_image,
+											 cmap=colormap('green_cmap'))
 		else:
 			self.green_plot = None
 		if self.show_red:
-			self.red_plot = self.ax.imshow(self.red_image ,cmap=red_cmap)
+			self.red_plot = self.ax.imshow(self.red_image,
+										   cmap=colormap('red_cmap'))
 		else:
 			self.red_plot = None
 		self.plot_box()
@@ -270,74 +237,72 @@ class MPLCanvas(FigureCanvas):
 				self.box_plot = None
 	
 	def plot_centres (self):
+		from matplotlib.collections import LineCollection
 		self.remove_centres()
 		scale = 800./(self.dapi_image.shape[0]) + \
 				800./(self.dapi_image.shape[1])
-		if self.dapi_centres.shape[0] > 0:
-			if self.epi_cells is not None:
-				if self.epi_cells.shape[0] > 0:
-					self.epi_centres_plot = self.ax.plot(
-									self.dapi_centres[self.epi_cells,0],
-									self.dapi_centres[self.epi_cells,1],
-									color = 'royalblue', linestyle = '', 
-									marker = 'o', markersize = scale*1.7)
+		if len(self.centres) > 0:
+			dapi_centres = self.centres.rows()['positions'][:,:2] + \
+															self.offset
+			green_cells, red_cells, epi_cells = self.centres.cells()
+			edges = self.edges.rows()['vertices']
+			edges_outer = self.edges.flag(EDGE_OUTER)
+			edges_outer_red = self.edges.flag(EDGE_RED)
+			edges_outer_green = self.edges.flag(EDGE_GREEN)
+			if np.any(epi_cells):
+				self.epi_centres_plot = self.ax.plot(
+								dapi_centres[epi_cells,0],
+								dapi_centres[epi_cells,1],
+								color = 'royalblue', linestyle = '', 
+								marker = 'o', markersize = scale*1.7)
 			self.dapi_centres_plot = self.ax.plot(
-									self.dapi_centres[:,0],
-									self.dapi_centres[:,1],
-									color = 'white', linestyle = '', 
-									marker = 'o', markersize = scale)
-			if (self.edges is not None) and self.show_mesh:
-				if self.edges.shape[0] > 0:
-					line_collection_edges = LineCollection(
-								self.dapi_centres[self.edges],
-									colors = 'white')
-					self.edges_plot = self.ax.add_collection(
-														line_collection_edges)
-			if self.edges_outer is not None:
-				if self.edges_outer.shape[0] > 0:
-					line_collection_outer = LineCollection(
-								self.dapi_centres[self.edges[self.edges_outer]],
-									colors = 'royalblue')
-					self.edges_outer_plot = self.ax.add_collection(
-														line_collection_outer)
-			if self.edges_outer_red is not None:
-				if self.edges_outer_red.shape[0] > 0:
-					line_collection_outer_red = LineCollection(
-						self.dapi_centres[self.edges[self.edges_outer_red]],
-									colors = 'crimson')
-					self.edges_outer_red_plot = self.ax.add_collection(
-												line_collection_outer_red)
-			if self.edges_outer_green is not None:
-				if self.edges_outer_green.shape[0] > 0:
-					line_collection_outer_green = LineCollection(
-						self.dapi_centres[self.edges[self.edges_outer_green]],
-									colors = 'seagreen')
-					self.edges_outer_green_plot = self.ax.add_collection(
-												line_collection_outer_green)
-			if (self.edges_outer_red is not None) and \
-			   (self.edges_outer_green is not None) :
-				if (self.edges_outer_red.shape[0] > 0) and \
-				   (self.edges_outer_green.shape[0] > 0):
-					line_collection_outer_purple = LineCollection(
-						self.dapi_centres[self.edges[self.edges_outer_red & \
-													 self.edges_outer_green]],
-									colors = 'seagreen')
-					self.edges_outer_purple_plot = self.ax.add_collection(
-												line_collection_outer_purple)
-			if self.red_cells is not None:
-				if self.red_cells.shape[0] > 0:
-					self.red_centres_plot = self.ax.plot(
-									self.dapi_centres[self.red_cells,0],
-									self.dapi_centres[self.red_cells,1],
-									color = 'crimson', linestyle = '', 
-									marker = '+', markersize = scale*1.3)
-			if self.green_cells is not None:
-				if self.green_cells.shape[0] > 0:
-					self.green_centres_plot = self.ax.plot(
-									self.dapi_centres[self.green_cells,0],
-									self.dapi_centres[self.green_cells,1],
-									color = 'seagreen', linestyle = '',
-									marker = 'x', markersize = scale)
+								dapi_centres[:,0],
+								dapi_centres[:,1],
+								color = 'white', linestyle = '', 
+								marker = 'o', markersize = scale)
+			if edges.shape[0] > 0 and self.show_mesh:
+				line_collection_edges = LineCollection(
+							dapi_centres[edges],
+								colors = 'white')
+				self.edges_plot = self.ax.add_collection(
+													line_collection_edges)
+			if np.any(edges_outer):
+				line_collection_outer = LineCollection(
+							dapi_centres[edges[edges_outer]],
+								colors = 'royalblue')
+				self.edges_outer_plot = self.ax.add_collection(
+													line_collection_outer)
+			if np.any(edges_outer_red):
+				line_collection_outer_red = LineCollection(
+							dapi_centres[edges[edges_outer_red]],
+								colors = 'crimson')
+				self.edges_outer_red_plot = self.ax.add_collection(
+											line_collection_outer_red)
+			if np.any(edges_outer_green):
+				line_collection_outer_green = LineCollection(
+							dapi_centres[edges[edges_outer_green]],
+								colors = 'seagreen')
+				self.edges_outer_green_plot = self.ax.add_collection(
+											line_collection_outer_green)
+			if np.any(edges_outer_red & edges_outer_green):
+				line_collection_outer_purple = LineCollection(
+							dapi_centres[edges[edges_outer_red & \
+											   edges_outer_green]],
+								colors = 'seagreen')
+				self.edges_outer_purple_plot = self.ax.add_collection(
+											line_collection_outer_purple)
+			if np.any(red_cells):
+				self.red_centres_plot = self.ax.plot(
+								dapi_centres[red_cells,0],
+								dapi_centres[red_cells,1],
+								color = 'crimson', linestyle = '', 
+								marker = '+', markersize = scale*1.3)
+			if np.any(green_cells):
+				self.green_centres_plot = self.ax.plot(
+								dapi_centres[green_cells,0],
+								dapi_centres[green_cells,1],
+								color = 'seagreen', linestyle = '',
+								marker = 'x', markersize = scale)
 	
 	def remove_plot_element (self, plot_element):
 		if isinstance(plot_element,list):
@@ -395,46 +360,15 @@ class MPLCanvas(FigureCanvas):
 # main window widget #
 ######################
 
-class Window(QWidget):
+class Window(QWidget, Pipeline):
 	def __init__ (self):
-		super().__init__()
-		self.green_active = True
-		self.red_active = True
-		self.geometry_active = True
-		self.green_cutoff_active = False
-		self.red_cutoff_active = False
-		self.threshold_defaults = np.array([180,2000,4095,4095,
-											320,2000,4095,4095,
-											50,40,10])
-		self.green_lower = self.threshold_defaults[0]
-		self.green_upper = self.threshold_defaults[1]
-		self.green_cutoff = self.threshold_defaults[2]
-		self.green_max = self.threshold_defaults[3]
-		self.red_lower = self.threshold_defaults[4]
-		self.red_upper = self.threshold_defaults[5]
-		self.red_cutoff = self.threshold_defaults[6]
-		self.red_max = self.threshold_defaults[7]
-		self.geo_edge_max = self.threshold_defaults[8]
-		self.geo_distance = self.threshold_defaults[9]
-		self.geo_dist_red = self.threshold_defaults[10]
-		self.geo_size = int(512/8)
-		self.x_lower = 0
-		self.x_upper = 0
-		self.x_size = 512
-		self.y_lower = 0
-		self.y_upper = 0
-		self.y_size = 512
+		QWidget.__init__(self)
+		Pipeline.__init__(self)
 		self.z_level = 0
-		self.z_size = 1
-		self.z_lower = 0
-		self.z_upper = 0
 		self.zoomed = False
 		self.dapi_image = np.ones((512,512),dtype=int)
 		self.green_image = np.zeros((512,512),dtype=int)
 		self.red_image = np.zeros((512,512),dtype=int)
-		self.nd2_file = None
-		self.czi_file = None
-		self.image_stack = None
 		self.title = "ND2 Nuclear Positions Tool"
 		self.canvas = MPLCanvas()
 		self.toolbar = NavigationToolbar(self.canvas, self)
@@ -442,25 +376,15 @@ class Window(QWidget):
 		self.click_id = 0
 		self.move_id = 0
 		self.position = np.array([0,0])
-		self.advanced_defaults = np.array([9,1,4,2,6,4])
-		self.neighbourhood_size = self.advanced_defaults[0]
-		self.threshold_difference = self.advanced_defaults[1]
-		self.minimum_distance = self.advanced_defaults[2]
-		self.gauss_deviation = self.advanced_defaults[3]
-		self.max_layer_distance = self.advanced_defaults[4]
-		self.number_layer_cell = self.advanced_defaults[5]
-		self.scale = np.array([0.232, 0.232, 0.479])
-		self.dapi_centres = np.zeros((0,2), dtype = float)
-		self.green_cells = np.zeros((0,1), dtype = bool)
-		self.red_cells = np.zeros((0,1), dtype = bool)
-		self.epi_cells = np.zeros((0,1), dtype = bool)
-		self.edges = np.zeros((0,2), dtype = int)
-		self.edges_outer = np.zeros((0,1), dtype = bool)
-		self.edges_outer_red = np.zeros((0,1), dtype = bool)
-		self.edges_outer_green = np.zeros((0,1), dtype = bool)
-		self.mesh = None
+		# preview results of the current slice, shared with the canvas
+		self.centres = ResultTable(result_dtype)
+		self.edges = ResultTable(edge_dtype)
 		self.plot_mesh = False
 		self.plot_dapi = False
+		self.preview_binning = 1
+		self.strip_slices = 9
+		self.lod_points = 20000
+		self.plot_results = False
 		#
 		self.setupGUI()
 	
@@ -491,6 +415,14 @@ class Window(QWidget):
 		self.button_z_max.setText('Set Z Max')
 		self.button_z_max.clicked.connect(self.z_max_button)
 		toolbar_layout.addWidget(self.button_z_max)
+		self.button_z_auto = QPushButton()
+		self.button_z_auto.setText('Auto Z')
+		self.button_z_auto.clicked.connect(self.z_auto_button)
+		toolbar_layout.addWidget(self.button_z_auto)
+		self.button_auto_range = QPushButton()
+		self.button_auto_range.setText('Auto Range')
+		self.button_auto_range.clicked.connect(self.auto_range_button)
+		toolbar_layout.addWidget(self.button_auto_range)
 		plot_layout.addLayout(toolbar_layout)
 		main_layout.addLayout(plot_layout)
 		# main right for options
@@ -660,6 +592,19 @@ class Window(QWidget):
 		self.checkbox_geo.setChecked(self.geometry_active)
 		self.checkbox_geo.stateChanged.connect(self.geo_checkbox)
 		tab_geo.layout.addWidget(self.checkbox_geo)
+		# checkbox to triangulate in overlapping blocks
+		self.checkbox_geo_chunked = QCheckBox("chunked triangulation")
+		self.checkbox_geo_chunked.setChecked(self.geo_chunked)
+		self.checkbox_geo_chunked.stateChanged.connect(
+												self.geo_chunked_checkbox)
+		tab_geo.layout.addWidget(self.checkbox_geo_chunked)
+		# selection of the surface distance engine
+		self.combobox_geo_engine = QComboBox()
+		self.combobox_geo_engine.addItems(['mesh', 'voxel'])
+		self.combobox_geo_engine.setCurrentText(self.geo_engine)
+		self.combobox_geo_engine.currentTextChanged.connect(
+												self.geo_engine_select)
+		tab_geo.layout.addWidget(self.combobox_geo_engine)
 		# sliders for geometry thresholds
 		threshold_layout_geo = QHBoxLayout()
 		# geometry max edge length
@@ -823,11 +768,26 @@ class Window(QWidget):
 		self.checkbox_mesh.stateChanged.connect(self.mesh_checkbox)
 		zoom_layout.addWidget(self.checkbox_mesh)
 		#
+		self.checkbox_results = QCheckBox("3d results")
+		self.checkbox_results.setChecked(self.plot_results)
+		self.checkbox_results.stateChanged.connect(self.results_checkbox)
+		zoom_layout.addWidget(self.checkbox_results)
+		#
 		self.checkbox_dapi = QCheckBox("3d dapi")
 		self.checkbox_dapi.setChecked(self.plot_dapi)
 		self.checkbox_dapi.stateChanged.connect(self.dapi_checkbox)
 		zoom_layout.addWidget(self.checkbox_dapi)
 		#
+		self.checkbox_cache = QCheckBox("cache results")
+		self.checkbox_cache.setChecked(self.use_cache)
+		self.checkbox_cache.stateChanged.connect(self.cache_checkbox)
+		zoom_layout.addWidget(self.checkbox_cache)
+		#
+		self.checkbox_resume = QCheckBox("resume run")
+		self.checkbox_resume.setChecked(self.resume_run)
+		self.checkbox_resume.stateChanged.connect(self.resume_checkbox)
+		zoom_layout.addWidget(self.checkbox_resume)
+		#
 		options_layout.addLayout(zoom_layout)
 		main_layout.addLayout(options_layout)
 		# horizontal row of buttons
@@ -843,6 +803,11 @@ class Window(QWidget):
 		self.button_preview.clicked.connect(self.preview)
 		buttons_layout.addWidget(self.button_preview)
 		#
+		self.button_preview_strip = QPushButton()
+		self.button_preview_strip.setText('Preview Strip')
+		self.button_preview_strip.clicked.connect(self.preview_strip_button)
+		buttons_layout.addWidget(self.button_preview_strip)
+		#
 		self.button_execute = QPushButton()
 		self.button_execute.setText('Execute')
 		self.button_execute.clicked.connect(self.execute)
@@ -852,6 +817,21 @@ class Window(QWidget):
 		self.button_open_csv.setText('Open CSV')
 		self.button_open_csv.clicked.connect(self.open_csv)
 		buttons_layout.addWidget(self.button_open_csv)
+		#
+		self.button_reclassify = QPushButton()
+		self.button_reclassify.setText('Reclassify')
+		self.button_reclassify.clicked.connect(self.reclassify)
+		buttons_layout.addWidget(self.button_reclassify)
+		#
+		self.button_query = QPushButton()
+		self.button_query.setText('Query Region')
+		self.button_query.clicked.connect(self.query_button)
+		buttons_layout.addWidget(self.button_query)
+		#
+		self.button_save_profile = QPushButton()
+		self.button_save_profile.setText('Save Profile')
+		self.button_save_profile.clicked.connect(self.store_profile)
+		buttons_layout.addWidget(self.button_save_profile)
 		# Layouts for advanced settings boxes
 		advanced_layout = QHBoxLayout()
 		neighbourhood_label = QLabel('Neighbourhood:')
@@ -926,6 +906,51 @@ class Window(QWidget):
 												self.advanced_textbox_select)
 		advanced_layout.addWidget(self.textbox_layer_number)
 		#
+		preview_label = QLabel('Preview:')
+		preview_label.setAlignment(Qt.AlignCenter)
+		advanced_layout.addWidget(preview_label)
+		self.combobox_preview = QComboBox()
+		self.combobox_preview.addItems(['full', '2x', '4x'])
+		self.combobox_preview.currentTextChanged.connect(
+												self.preview_quality_select)
+		advanced_layout.addWidget(self.combobox_preview)
+		#
+		detector_label = QLabel('Detector:')
+		detector_label.setAlignment(Qt.AlignCenter)
+		advanced_layout.addWidget(detector_label)
+		self.combobox_detector = QComboBox()
+		self.combobox_detector.addItems(['maxima', 'dog'])
+		self.combobox_detector.setCurrentText(self.detector)
+		self.combobox_detector.currentTextChanged.connect(
+												self.detector_select)
+		advanced_layout.addWidget(self.combobox_detector)
+		#
+		segmentation_label = QLabel('Nuclei:')
+		segmentation_label.setAlignment(Qt.AlignCenter)
+		advanced_layout.addWidget(segmentation_label)
+		self.combobox_segmentation = QComboBox()
+		self.combobox_segmentation.addItems(['box', 'watershed'])
+		self.combobox_segmentation.setCurrentText(self.segmentation)
+		self.combobox_segmentation.currentTextChanged.connect(
+												self.segmentation_select)
+		advanced_layout.addWidget(self.combobox_segmentation)
+		#
+		self.checkbox_low_memory = QCheckBox("Low Memory")
+		self.checkbox_low_memory.setChecked(self.low_memory)
+		self.checkbox_low_memory.stateChanged.connect(self.low_memory_checkbox)
+		advanced_layout.addWidget(self.checkbox_low_memory)
+		#
+		self.checkbox_skip_empty = QCheckBox("Skip Empty")
+		self.checkbox_skip_empty.setChecked(self.skip_empty)
+		self.checkbox_skip_empty.stateChanged.connect(self.skip_empty_checkbox)
+		advanced_layout.addWidget(self.checkbox_skip_empty)
+		#
+		self.checkbox_stack_reference = QCheckBox("Stack Reference")
+		self.checkbox_stack_reference.setChecked(self.stack_reference)
+		self.checkbox_stack_reference.stateChanged.connect(
+											self.stack_reference_checkbox)
+		advanced_layout.addWidget(self.checkbox_stack_reference)
+		#
 		self.button_advanced_defaults = QPushButton()
 		self.button_advanced_defaults.setText('Defaults')
 		self.button_advanced_defaults.clicked.connect(self.reset_defaults)
@@ -1018,6 +1043,36 @@ class Window(QWidget):
 		self.z_upper = self.z_level
 		self.setup_bound_textboxes()
 	
+	def z_auto_button (self):
+		if self.nd2_file == None or self.nd2_file == '':
+			return
+		try:
+			z_lower, z_upper, empty = self.suggest_z_bounds()
+		except Exception:
+			self.progress_bar.reset()
+			self.show_error('Problem extracting data!')
+			return
+		self.z_lower = int(z_lower)
+		self.z_upper = int(z_upper)
+		self.setup_bound_textboxes()
+		self.progress_bar.setFormat(
+				'{0:d} of {1:d} slices empty at the ends'.format(int(empty),
+															  self.z_size))
+	
+	def auto_range_button (self):
+		if self.nd2_file == None or self.nd2_file == '':
+			return
+		try:
+			suggestions = self.suggest_thresholds()
+		except Exception:
+			self.progress_bar.reset()
+			self.show_error('Problem extracting data!')
+			return
+		for name, value in suggestions.items():
+			setattr(self, name, value)
+		self.setup_threshold_textboxes()
+		self.setup_threshold_sliders()
+	
 	def z_textbox_select (self):
 		input_z = int(self.textbox_z.text())
 		if input_z > 0 and input_z < self.z_size:
@@ -1032,6 +1087,8 @@ class Window(QWidget):
 		self.textbox_z.setText(str(self.z_level))
 		self.dapi_image, self. green_image, self.red_image = \
 											self.extract_image(self.z_level)
+		if self.plot_results:
+			self.overlay_results()
 		self.replot()
 	
 	def threshold_green_lower (self):
@@ -1091,6 +1148,12 @@ class Window(QWidget):
 		self.geo_active = self.checkbox_geo.isChecked()
 		self.replot()
 	
+	def geo_chunked_checkbox (self):
+		self.geo_chunked = self.checkbox_geo_chunked.isChecked()
+	
+	def geo_engine_select (self):
+		self.geo_engine = self.combobox_geo_engine.currentText()
+	
 	def green_cutoff_checkbox (self):
 		self.green_cutoff_active = self.checkbox_green_cutoff.isChecked()
 		self.replot()
@@ -1099,6 +1162,25 @@ class Window(QWidget):
 		self.red_cutoff_active = self.checkbox_red_cutoff.isChecked()
 		self.replot()
 	
+	def preview_quality_select (self):
+		text = self.combobox_preview.currentText()
+		self.preview_binning = 1 if text == 'full' else int(text[:-1])
+	
+	def detector_select (self):
+		self.detector = self.combobox_detector.currentText()
+	
+	def segmentation_select (self):
+		self.segmentation = self.combobox_segmentation.currentText()
+	
+	def low_memory_checkbox (self):
+		self.low_memory = self.checkbox_low_memory.isChecked()
+	
+	def skip_empty_checkbox (self):
+		self.skip_empty = self.checkbox_skip_empty.isChecked()
+	
+	def stack_reference_checkbox (self):
+		self.stack_reference = self.checkbox_stack_reference.isChecked()
+	
 	def zoom_checkbox (self):
 		self.zoomed = self.checkbox_zoom.isChecked()
 		self.replot()
@@ -1107,6 +1189,31 @@ class Window(QWidget):
 		self.plot_dapi = self.checkbox_dapi.isChecked()
 		self.replot()
 	
+	def cache_checkbox (self):
+		self.use_cache = self.checkbox_cache.isChecked()
+	
+	def resume_checkbox (self):
+		self.resume_run = self.checkbox_resume.isChecked()
+	
+	def results_checkbox (self):
+		self.plot_results = self.checkbox_results.isChecked()
+		if self.plot_results:
+			self.overlay_results()
+		else:
+			self.clear_centres()
+		self.replot()
+	
+	def overlay_results (self):
+		# the nuclei of the last results that span the current slice take
+		# the place of the preview centres
+		if self.results is None:
+			return
+		rows = self.slice_results(self.z_level)
+		self.clear_centres()
+		self.centres.append(positions = rows['positions'] - \
+								np.array([self.x_lower, self.y_lower, 0]),
+							flags = rows['flags'])
+	
 	def mesh_checkbox (self):
 		self.plot_mesh = self.checkbox_mesh.isChecked()
 		self.replot()
@@ -1272,14 +1379,8 @@ class Window(QWidget):
 		self.replot()
 	
 	def clear_centres (self):
-		self.dapi_centres = np.zeros((0,2), dtype = float)
-		self.green_cells = np.zeros((0,1), dtype = bool)
-		self.red_cells = np.zeros((0,1), dtype = bool)
-		self.epi_cells = np.zeros((0,1), dtype = bool)
-		self.edges = np.zeros((0,2), dtype = int)
-		self.edges_outer = np.zeros((0,1), dtype = bool)
-		self.edges_outer_red = np.zeros((0,1), dtype = bool)
-		self.edges_outer_green = np.zeros((0,1), dtype = bool)
+		self.centres.clear()
+		self.edges.clear()
 	
 	def replot (self):
 		dapi_display = self.dapi_image
@@ -1306,14 +1407,7 @@ class Window(QWidget):
 						show_box = False,
 						show_mesh = self.plot_mesh
 					)
-			self.canvas.update_centres(self.dapi_centres,
-									   self.green_cells,
-									   self.red_cells,
-									   self.epi_cells,
-									   self.edges,
-									   self.edges_outer,
-									   self.edges_outer_red,
-									   self.edges_outer_green)
+			self.canvas.update_centres(self.centres, self.edges)
 		else:
 			self.canvas.update_images(
 						dapi_display,
@@ -1328,15 +1422,8 @@ class Window(QWidget):
 						show_box = True,
 						show_mesh = self.plot_mesh
 					)
-			self.canvas.update_centres(self.dapi_centres + \
-								np.array([self.x_lower,self.y_lower]),
-									   self.green_cells,
-									   self.red_cells,
-									   self.epi_cells,
-									   self.edges,
-									   self.edges_outer,
-									   self.edges_outer_red,
-									   self.edges_outer_green)
+			self.canvas.update_centres(self.centres, self.edges,
+								np.array([self.x_lower,self.y_lower]))
 	
 	def open_file (self):
 		options = QFileDialog.Options()
@@ -1378,30 +1465,11 @@ class Window(QWidget):
 		else:
 			self.nd2_file = Path(file_name)
 		try:
-			self.image_stack = ND2Reader(str(self.nd2_file))
-			self.x_size = self.image_stack.sizes['x']
-			self.y_size = self.image_stack.sizes['y']
-			self.z_size = self.image_stack.sizes['z']
-			self.geo_size = int(min(self.x_size,self.y_size)/8)
-			self.x_lower = 0
-			self.x_upper = self.x_size-1
-			self.y_lower = 0
-			self.y_upper = self.y_size-1
-			self.z_lower = 0
-			self.z_upper = self.z_size-1
+			self.open_stack(self.nd2_file)
 			self.setup_bound_textboxes()
-			self.scale[0] = self.image_stack.metadata['pixel_microns']
-			self.scale[1] = self.image_stack.metadata['pixel_microns']
-			self.scale[2] = self.image_stack.metadata['z_coordinates'][1] - \
-							self.image_stack.metadata['z_coordinates'][0]
 		except:
 			self.nd2_file = None
-			msg = QMessageBox()
-			msg.setIcon(QMessageBox.Critical)
-			msg.setText("Error")
-			msg.setInformativeText('Could not open file!')
-			msg.setWindowTitle("Error")
-			msg.exec_()
+			self.show_error('Could not open file!')
 			return
 		self.dapi_image, self. green_image, self.red_image = \
 											self.extract_image(self.z_level)
@@ -1420,499 +1488,293 @@ class Window(QWidget):
 			red_image = self.red_image
 		else:
 			red_image = None
-		self.dapi_centres, self.green_cells, self.red_cells = \
+		if self.preview_binning > 1:
+			dapi_centres, green_cells, red_cells = \
+					self.process_binned(self.dapi_image, green_image,
+										red_image, self.preview_binning)
+		else:
+			dapi_centres, green_cells, red_cells = \
 					self.process_image(self.dapi_image,
 										green_image, red_image)
-		triangulation = Delaunay(self.dapi_centres)
+		from scipy.spatial import Delaunay
+		triangulation = Delaunay(dapi_centres)
 		self.mesh = SimplicialComplex(triangulation.points,
 									  triangulation.simplices,
 									  triangulation.neighbors)
 		self.mesh.remove_long_simplices(self.geo_edge_max)
-		self.edges, count = np.unique(np.sort(
-									np.vstack([self.mesh.simplices[:,:2],
-											   self.mesh.simplices[:,1:],
-											   self.mesh.simplices[:,::2]]),
-								axis=1), return_counts = True, axis=0)
-		self.edges_outer = (count == 1)
+		edges, edges_outer = self.mesh.facets()
 		if self.x_lower > 0:
-			self.edges_outer = self.edges_outer & \
-				(self.dapi_centres[self.edges[:,0],0] > self.geo_edge_max/3) & \
-				(self.dapi_centres[self.edges[:,1],0] > self.geo_edge_max/3)
+			edges_outer = edges_outer & \
+				(dapi_centres[edges[:,0],0] > self.geo_edge_max/3) & \
+				(dapi_centres[edges[:,1],0] > self.geo_edge_max/3)
 		if self.y_lower > 0:
-			self.edges_outer = self.edges_outer & \
-				(self.dapi_centres[self.edges[:,0],1] > self.geo_edge_max/3) & \
-				(self.dapi_centres[self.edges[:,1],1] > self.geo_edge_max/3)
+			edges_outer = edges_outer & \
+				(dapi_centres[edges[:,0],1] > self.geo_edge_max/3) & \
+				(dapi_centres[edges[:,1],1] > self.geo_edge_max/3)
 		if self.x_upper < self.x_size-1:
-			self.edges_outer = self.edges_outer & \
-				(self.dapi_centres[self.edges[:,0],0] < \
+			edges_outer = edges_outer & \
+				(dapi_centres[edges[:,0],0] < \
 					self.x_upper - self.x_lower - self.geo_edge_max/3) & \
-				(self.dapi_centres[self.edges[:,1],0] < \
+				(dapi_centres[edges[:,1],0] < \
 					self.x_upper - self.x_lower - self.geo_edge_max/3)
 		if self.y_upper < self.y_size-1:
-			self.edges_outer = self.edges_outer & \
-				(self.dapi_centres[self.edges[:,0],1] < \
+			edges_outer = edges_outer & \
+				(dapi_centres[edges[:,0],1] < \
 					self.y_upper - self.y_lower - self.geo_edge_max/3) & \
-				(self.dapi_centres[self.edges[:,1],1] < \
+				(dapi_centres[edges[:,1],1] < \
 					self.y_upper - self.y_lower - self.geo_edge_max/3)
-		self.edges_outer_red = self.edges_outer.copy()
-		outer_edges = self.edges[self.edges_outer]
-		points_inner = np.ones(self.dapi_centres.shape[0], dtype = bool)
+		edges_outer_red = edges_outer.copy()
+		outer_edges = edges[edges_outer]
+		points_inner = np.ones(dapi_centres.shape[0], dtype = bool)
 		points_inner[np.unique(outer_edges)] = False
-		self.edges_outer_red[self.edges_outer] = \
-					self.red_cells[outer_edges[:,0]] & \
-					self.red_cells[outer_edges[:,1]]
-		distances = np.zeros((self.dapi_centres.shape[0], outer_edges.shape[0]),
-								dtype = float)
-		for index, edge in enumerate(outer_edges):
-			distances[points_inner,index] = lineseg_dists(
-										self.dapi_centres[points_inner],
-										self.dapi_centres[edge[0]],
-										self.dapi_centres[edge[1]])
-		min_indices = np.argmin(distances, axis=1)
-		closest_is_red = self.edges_outer_red[self.edges_outer][min_indices]
-		min_distance = np.min(distances, axis=1)
-		self.epi_cells = ((min_distance < self.geo_dist_red) & \
+		edges_outer_red[edges_outer] = \
+					red_cells[outer_edges[:,0]] & \
+					red_cells[outer_edges[:,1]]
+		# points on the outer edges keep zero distance to the first edge
+		min_distance = np.zeros(dapi_centres.shape[0], dtype = float)
+		min_indices = np.zeros(dapi_centres.shape[0], dtype = int)
+		min_distance[points_inner], min_indices[points_inner] = \
+					nearest_segments(dapi_centres[points_inner],
+									 dapi_centres[outer_edges[:,0]],
+									 dapi_centres[outer_edges[:,1]])
+		closest_is_red = edges_outer_red[edges_outer][min_indices]
+		epi_cells = ((min_distance < self.geo_dist_red) & \
 													closest_is_red) | \
 						 ((min_distance < self.geo_distance) & \
 											np.logical_not(closest_is_red))
+		self.centres.clear()
+		self.centres.append(positions = np.column_stack([dapi_centres,
+							np.full(dapi_centres.shape[0], self.z_level)]),
+							flags = pack_flags(green_cells, red_cells,
+											   epi_cells))
+		self.edges.clear()
+		self.edges.append(vertices = edges,
+						  flags = edges_outer * EDGE_OUTER + \
+								  edges_outer_red * EDGE_RED)
 		self.replot()
 	
+	def preview_strip_button (self):
+		if self.nd2_file == None or self.nd2_file == '':
+			return
+		try:
+			strip = self.preview_strip(self.strip_slices, self.preview_binning)
+		except Exception:
+			self.progress_bar.reset()
+			self.show_error('Problem extracting data!')
+			return
+		self.plot_strip(strip)
+	
 	def execute (self):
 		if self.nd2_file == None or self.nd2_file == '':
 			return
 		if self.z_upper <= self.z_lower:
 			return
-		positions_layer = np.zeros((0,3), dtype = float)
-		green_cells_layer = np.zeros(0, dtype = bool)
-		red_cells_layer = np.zeros(0, dtype = bool)
-		self.progress_bar.setRange(self.z_lower, self.z_upper)
-		self.progress_bar.setValue(self.z_lower)
-		self.progress_bar.setFormat('Processing Z-Stack: %p%')
-		for z_level in range(self.z_lower, self.z_upper+1):
-			dapi_image, green_image, red_image = self.extract_image(z_level)
-			if not self.green_active:
-				green_image = None
-			if not self.red_active:
-				red_image = None
-			dapi_centres, green_cells, red_cells = self.process_image(
-											dapi_image, green_image, red_image)
-			positions_layer = np.vstack([positions_layer,
-				np.vstack([(dapi_centres + np.array([self.x_lower,
-													 self.y_lower])).T,
-						np.ones(dapi_centres.shape[0])*z_level]).T])
-			green_cells_layer = np.append(green_cells_layer, green_cells)
-			red_cells_layer = np.append(red_cells_layer, red_cells)
-			self.progress_bar.setValue(z_level)
-		self.progress_bar.reset()
-		self.progress_bar.setMinimum(0)
-		positions_layer_size = positions_layer.shape[0]
-		self.progress_bar.setMaximum(positions_layer.shape[0])
-		self.progress_bar.setValue(0)
-		self.progress_bar.setFormat('Correlating Layers: %p%')
-		positions = np.zeros((0,3), dtype = float)
-		green_cells = np.zeros(0, dtype = bool)
-		red_cells = np.zeros(0, dtype = bool)
-		while positions_layer.shape[0] > 0:
-			x_0, y_0, z_0 = positions_layer[0]
-			found_on_next_layer = True
-			layer_index = 1
-			positions_temp = np.zeros((0,3), dtype = float)
-			green_cells_temp = np.zeros(0, dtype = bool)
-			red_cells_temp = np.zeros(0, dtype = bool)
-			while found_on_next_layer and \
-				  layer_index < positions_layer.shape[0]:
-				found_on_next_layer = False
-				# find next layer
-				on_layer = (positions_layer[:,2] == z_0+1)
-				layer_index = np.argmax(on_layer)
-				if layer_index > 0 and \
-				   layer_index < positions_layer.shape[0]:
-					z_0 = positions_layer[layer_index,2]
-					distances = np.linalg.norm(
-										positions_layer[on_layer,:2] - \
-											np.array([x_0,y_0]), axis=1)
-					local_index = np.argmin(distances)
-					if distances[local_index] < self.minimum_distance:
-						found_on_next_layer = True
-						index = layer_index + local_index
-						positions_temp = np.vstack([positions_temp,
-													positions_layer[index]])
-						x_0 = (x_0 * positions_temp.shape[0] + \
-								positions_temp[-1,0]) / \
-									(positions_temp.shape[0]+1)
-						y_0 = (y_0 * positions_temp.shape[0] + \
-								positions_temp[-1,1]) / \
-									(positions_temp.shape[0]+1)
-						positions_layer = np.delete(positions_layer, index,
-														axis=0)
-						green_cells_temp = np.append(green_cells_temp,
-													green_cells_layer[index])
-						green_cells_layer = np.delete(green_cells_layer,
-															index, axis=0)
-						red_cells_temp = np.append(red_cells_temp,
-													red_cells_layer[index])
-						red_cells_layer = np.delete(red_cells_layer,
-															index, axis=0)
-			if positions_temp.shape[0] >= self.number_layer_cell:
-				positions = np.vstack([positions, np.mean(positions_temp,
-															axis=0)])
-				green_cells = np.append(green_cells,
-										np.count_nonzero(green_cells_temp) >= \
-													green_cells_temp.shape[0]/2)
-				red_cells = np.append(red_cells,
-										np.count_nonzero(red_cells_temp) >= \
-													red_cells_temp.shape[0]/2)
-			positions_layer = np.delete(positions_layer, 0, axis=0)
-			green_cells_layer = np.delete(green_cells_layer,0)
-			red_cells_layer = np.delete(red_cells_layer,0)
-			layers_processed = positions_layer_size - positions_layer.shape[0]
-			self.progress_bar.setValue(layers_processed)
-		positions = positions * self.scale
-		epi_cells = np.zeros(len(red_cells), dtype = bool)
-		self.progress_bar.reset()
-		if self.geometry_active:
-			self.progress_bar.setMinimum(0)
-			self.progress_bar.setMaximum(positions.shape[0])
-			self.progress_bar.setValue(0)
-			self.progress_bar.setFormat('Finding Epithelial Cells: %p%')
-			triangulation = Delaunay(positions)
-			mesh_3d = SimplicialComplex(triangulation.points,
-										triangulation.simplices,
-										triangulation.neighbors)
-			mesh_3d.remove_long_simplices(self.geo_edge_max)
-			faces_all, count = np.unique(np.sort(
-								np.vstack([mesh_3d.simplices[:,(0,1,2)],
-										   mesh_3d.simplices[:,(0,1,3)],
-										   mesh_3d.simplices[:,(0,2,3)],
-										   mesh_3d.simplices[:,(1,2,3)]]),
-								axis=1), return_counts = True, axis=0)
-			faces_outer = faces_all[count == 1]
-			outer_points_indices = np.unique(faces_outer)
-			points = positions[outer_points_indices]
-			outer_points_dict = np.zeros(positions.shape[0], dtype = int)
-			outer_points_dict[outer_points_indices] = np.arange(
-													len(outer_points_indices))
-			faces = outer_points_dict[faces_outer]
-			points_red = red_cells[outer_points_indices]
-			faces_red = (points_red[faces[:,0]] & points_red[faces[:,1]]) | \
-						(points_red[faces[:,0]] & points_red[faces[:,2]]) | \
-						(points_red[faces[:,1]] & points_red[faces[:,2]])
-			points_green = green_cells[outer_points_indices]
-			faces_green = (points_green[faces[:,0]] & \
-								points_green[faces[:,1]]) | \
-						  (points_green[faces[:,0]] & \
-								points_green[faces[:,2]]) | \
-						  (points_green[faces[:,1]] & \
-								points_green[faces[:,2]])
-			faces_purple = faces_red & faces_green
-			surface_mesh = Trimesh(vertices = points, faces = faces)
-			surface_mesh.export(self.nd2_file.with_suffix(
-					'.{0:s}.stl'.format(time.strftime("%Y.%m.%d-%H.%M.%S"))))
-			fix_normals(surface_mesh)
-			mask = np.zeros(faces.shape[0], dtype = bool)
-			if self.x_lower > 0:
-				mask = mask | \
-					((points[faces[:,0],0] < (self.x_lower + \
-									self.geo_edge_max/3) * self.scale[0]) & \
-					 (points[faces[:,1],0] < (self.x_lower + \
-									self.geo_edge_max/3) * self.scale[0]) & \
-					 (points[faces[:,2],0] < (self.x_lower + \
-									self.geo_edge_max/3) * self.scale[0]) & \
-					 (np.abs(surface_mesh.face_normals[:,0]) > 0.7))
-			if self.y_lower > 0:
-				mask = mask | \
-					((points[faces[:,0],1] < (self.y_lower + \
-									self.geo_edge_max/3) * self.scale[0]) & \
-					 (points[faces[:,1],1] < (self.y_lower + \
-									self.geo_edge_max/3) * self.scale[0]) & \
-					 (points[faces[:,2],1] < (self.y_lower + \
-									self.geo_edge_max/3) * self.scale[0]) & \
-					 (np.abs(surface_mesh.face_normals[:,1]) > 0.7))
-			if self.z_lower > 0:
-				mask = mask | \
-					((points[faces[:,0],2] < (self.z_lower + \
-									self.geo_edge_max/3) * self.scale[0]) & \
-					 (points[faces[:,1],2] < (self.z_lower + \
-									self.geo_edge_max/3) * self.scale[0]) & \
-					 (points[faces[:,2],2] < (self.z_lower + \
-									self.geo_edge_max/3) * self.scale[0]) & \
-					 (np.abs(surface_mesh.face_normals[:,2]) > 0.7))
-			if self.x_upper < self.x_size-1:
-				mask = mask | \
-					((points[faces[:,0],0] > (self.x_upper - \
-									self.geo_edge_max/3) * self.scale[0]) & \
-					 (points[faces[:,1],0] > (self.x_upper - \
-									self.geo_edge_max/3) * self.scale[0]) & \
-					 (points[faces[:,2],0] > (self.x_upper - \
-									self.geo_edge_max/3) * self.scale[0]) & \
-					 (np.abs(surface_mesh.face_normals[:,0]) > 0.7))
-			if self.y_upper < self.y_size-1:
-				mask = mask | \
-					((points[faces[:,0],1] > (self.y_upper - \
-									self.geo_edge_max/3) * self.scale[0]) & \
-					 (points[faces[:,1],1] > (self.y_upper - \
-									self.geo_edge_max/3) * self.scale[0]) & \
-					 (points[faces[:,2],1] > (self.y_upper - \
-									self.geo_edge_max/3) * self.scale[0]) & \
-					 (np.abs(surface_mesh.face_normals[:,1]) > 0.7))
-			if self.z_upper < self.z_size-1:
-				mask = mask | \
-					((points[faces[:,0],2] > (self.z_upper - \
-									self.geo_edge_max/3) * self.scale[0]) & \
-					 (points[faces[:,1],2] > (self.z_upper - \
-									self.geo_edge_max/3) * self.scale[0]) & \
-					 (points[faces[:,2],2] > (self.z_upper - \
-									self.geo_edge_max/3) * self.scale[0]) & \
-					 (np.abs(surface_mesh.face_normals[:,2]) > 0.7))
-			surface_mesh.update_faces(np.logical_not(mask))
-			fix_normals(surface_mesh)
-			mask = np.zeros(len(surface_mesh.faces), dtype = bool)
-			cc = connected_components(surface_mesh.face_adjacency, min_len=4)
-			mask[np.concatenate(cc)] = True
-			surface_mesh.update_faces(mask)
-			#surface_mesh.show()
-			#closest_points, distances, triangle_ids = \
-			#		surface_mesh.nearest.on_surface(positions)
-			for index, point in enumerate(positions):
-				closest_point, distance, triangle_id = \
-						surface_mesh.nearest.on_surface([point])
-				epi_cells[index] = ((distance[0] < self.geo_dist_red * \
-													self.scale[0]) and \
-												faces_red[triangle_id[0]]) | \
-								   ((distance[0] < self.geo_distance * \
-													self.scale[0]) and \
-											not faces_red[triangle_id[0]])
-				self.progress_bar.setValue(index)
-			###############################################################
-			#face_colors = np.ones((faces.shape[0],  4), dtype = int)*150
-			#face_colors[:,3] = 255
-			#face_colors[faces_red] = [[200,0,0,255]]
-			#face_colors[faces_green] = [[0,200,0,255]]
-			#face_colors[faces_purple] = [[120,0,120,255]]
-			#surface_mesh.visual.face_colors = face_colors
-			#surface_mesh.show(smooth=False)
-			###############################################################
+		try:
+			positions, green_cells, red_cells, epi_cells = self.run()
+		except Exception:
 			self.progress_bar.reset()
-			#
-		self.progress_bar.setMinimum(0)
-		self.progress_bar.setFormat('')
-		self.progress_bar.setMaximum(1)
-		self.progress_bar.setValue(0)
-		self.save_csv(positions, green_cells, red_cells, epi_cells)
+			self.show_error('Problem extracting data!')
+			return
+		if self.skipped_slices > 0:
+			self.progress_bar.setFormat('{0:d} empty slices skipped'.format(
+														self.skipped_slices))
+		self.plot_3d(positions, green_cells, red_cells, epi_cells)
+	
+	def show_results (self, results, parameters, scale, roi, extra_arrays):
+		positions, green_cells, red_cells, epi_cells = \
+							self.restore_results(results, extra_arrays)
+		self.slice_scale = np.asarray(scale, dtype = float)
 		self.plot_3d(positions, green_cells, red_cells, epi_cells)
 	
-	def save_csv (self, positions, green_cells, red_cells, epi_cells):
-		output_array = np.vstack([positions.T, green_cells, red_cells,
-									epi_cells]).T
-		data_format = '%.18e', '%.18e', '%.18e', '%1d', '%1d', '%1d'
-		np.savetxt(self.nd2_file.with_suffix(
-				'.{0:s}.csv'.format(time.strftime("%Y.%m.%d-%H.%M.%S"))),
-				output_array, fmt = data_format, delimiter = ',',
-				header = 'X,Y,Z,Is_Green,Is_Red,Is_Epithellial')
+	def store_profile (self):
+		name, accepted = QInputDialog.getText(self, 'Save Profile',
+											  'Profile name:')
+		if not accepted or name == '':
+			return
+		try:
+			save_profile(name, self.get_parameters())
+		except:
+			self.show_error('Could not save profile!')
+	
+	def reclassify (self):
+		if self.layer_offsets is None or self.results is None:
+			return
+		green_layer_cells, red_layer_cells = self.classify_cells(
+											self.layer_green, self.layer_red)
+		if not self.results.data.flags.writeable:
+			self.results = ResultTable(rows = np.array(self.results.rows()))
+		self.results.set_flag(FLAG_GREEN,
+						vote_cells(green_layer_cells, self.layer_offsets))
+		self.results.set_flag(FLAG_RED,
+						vote_cells(red_layer_cells, self.layer_offsets))
+		# the epithelial cells come from the surface of the whole stack, they
+		# keep the flags of the last run together with its graph and roi
+		self.plot_3d(self.results.rows()['positions'], *self.results.cells())
+	
+	def query_button (self):
+		if self.results is None or len(self.results) == 0:
+			return
+		text, accepted = QInputDialog.getText(self, 'Query Region',
+					'x, y, z, radius or x0, x1, y0, y1, z0, z1 (microns):')
+		if not accepted or text == '':
+			return
+		try:
+			values = [ float(value) for value in
+							text.replace(',', ' ').split() ]
+			if len(values) == 4:
+				query = ('radius', values[:3], values[3])
+			elif len(values) == 6:
+				query = ('box', values[0::2], values[1::2])
+			else:
+				raise ValueError(text)
+			indices = self.query_region(query)
+		except Exception:
+			self.show_error('Could not read the region!')
+			return
+		if len(indices) == 0:
+			self.show_error('No nuclei in the region!')
+			return
+		rows = self.results.rows()[indices]
+		self.plot_3d(rows['positions'], *unpack_flags(rows['flags']))
 	
 	def open_csv (self):
 		options = QFileDialog.Options()
 		options |= QFileDialog.DontUseNativeDialog
 		file_name, _ = QFileDialog.getOpenFileName(self,
-								"Open CSV File",
+								"Open Result File",
 								"",
-								"CSV Files (*.csv);;All Files (*)",
+								"Result Files (*.csv *.npz);;" + \
+								"CSV Files (*.csv);;" + \
+								"NPZ Files (*.npz);;All Files (*)",
 								options=options)
 		if file_name == '':
 			return
 		else:
 			csv_file = Path(file_name)
 		try:
+			if csv_file.suffix.lower() == '.npz':
+				self.show_results(*load_results(csv_file))
+				return
 			data_format = np.dtype([ ('positions', float, 3),
 									 ('green_cells', bool),
 									 ('red_cells', bool),
 									 ('epi_cells', bool) ])
 			input_data = np.loadtxt(str(csv_file), dtype = data_format,
 									delimiter=',').view(np.recarray)
-			self.plot_3d(input_data.positions, input_data.green_cells,
-											   input_data.red_cells,
-											   input_data.epi_cells)
+			# a csv holds only the rows, the graph, indexes and layers of
+			# the previous file are dropped as for an npz without them
+			results = result_table(input_data.positions,
+								   input_data.green_cells,
+								   input_data.red_cells,
+								   input_data.epi_cells)
+			self.show_results(results.rows(), {}, self.scale, None, {})
 		except:
-			msg = QMessageBox()
-			msg.setIcon(QMessageBox.Critical)
-			msg.setText("Error")
-			msg.setInformativeText('Could not open file!')
-			msg.setWindowTitle("Error")
-			msg.exec_()
+			self.show_error('Could not open file!')
 			return
 	
 	def extract_image (self, z_value):
-		dapi_image = np.zeros((0,2))
-		green_image = np.zeros((0,2))
-		red_image = np.zeros((0,2))
 		try:
-			channels = self.image_stack.metadata['channels']
-			for index, channel in enumerate(channels):
-				if channel == 'DAPI':
-					dapi_image = self.image_stack.get_frame_2D(
-										c = index,
-										z = z_value)
-				elif channel == 'Green':
-					green_image = self.image_stack.get_frame_2D(
-										c = index,
-										z = z_value)
-				elif channel == 'Red':
-					red_image = self.image_stack.get_frame_2D(
-										c = index,
-										z = z_value)
+			return self.read_frames(z_value)
 		except:
 			self.nd2_file = None
-			msg = QMessageBox()
-			msg.setIcon(QMessageBox.Critical)
-			msg.setText("Error")
-			msg.setInformativeText('Problem extracting data!')
-			msg.setWindowTitle("Error")
-			msg.exec_()
-		return dapi_image, green_image, red_image
-	
-	def process_image (self, dapi_image, green_image = None,
-										red_image = None):
-		dapi_centres = self.find_centres(dapi_image)
-		delta = self.neighbourhood_size # int(self.neighbourhood_size/2)
-		green_cells = np.zeros(dapi_centres.shape[0], dtype = bool)
-		if green_image is not None:
-			green_blur = green_image[self.y_lower:self.y_upper,
-									 self.x_lower:self.x_upper]
-			green_blur = mh.gaussian_filter(green_blur, self.gauss_deviation)
-		#	green_blur = np.where(green_blur > self.green_lower,
-		#					np.where(green_blur < self.green_upper,
-		#								green_blur, self.green_upper), 0)
-			green_blur = np.where(green_blur < self.green_upper,
-										green_blur, self.green_upper)
-		red_cells = np.zeros(dapi_centres.shape[0], dtype = bool)
-		if red_image is not None:
-			red_blur = red_image[self.y_lower:self.y_upper,
-								 self.x_lower:self.x_upper]
-			red_blur = mh.gaussian_filter(red_blur, self.gauss_deviation)
-		#	red_blur = np.where(red_blur > self.red_lower,
-		#					np.where(red_blur < self.red_upper,
-		#								red_blur, self.red_upper), 0)
-			red_blur = np.where(red_blur < self.red_upper,
-										red_blur, self.red_upper)
-		for index,(c_x,c_y) in enumerate(dapi_centres):
-			# median seems to work better than mean.
-			if green_image is not None:
-				if np.median(green_blur[c_y-delta:c_y+delta, # mean ?
-									  c_x-delta:c_x+delta]) > self.green_lower:
-					green_cells[index] = True
-			if red_image is not None:
-				if np.median(red_blur[c_y-delta:c_y+delta, # mean ?
-									c_x-delta:c_x+delta]) > self.red_lower:
-					red_cells[index] = True
-			if red_image is not None and green_image is not None:
-				if self.green_cutoff_active and \
-				   np.median(green_blur[c_y-delta:c_y+delta, # mean ?
-								c_x-delta:c_x+delta]) > self.green_cutoff:
-					red_cells[index] = False
-				if self.red_cutoff_active and \
-				   np.median(red_blur[c_y-delta:c_y+delta, # mean ?
-								c_x-delta:c_x+delta]) > self.red_cutoff:
-					green_cells[index] = False
-		return dapi_centres, green_cells, red_cells
-	
-	def find_centres (self, image):
-		frame = image[self.y_lower:self.y_upper,
-					  self.x_lower:self.x_upper]
-		frame = mh.gaussian_filter(frame, self.gauss_deviation)
-		frame_max = ndi.maximum_filter(frame, self.neighbourhood_size)
-		maxima = (frame == frame_max)
-		frame_min = ndi.minimum_filter(frame, self.neighbourhood_size)
-		differences = ((frame_max - frame_min) > self.threshold_difference)
-		maxima[differences == 0] = 0
-		maximum = np.amax(frame)
-		minimum = np.amin(frame)
-		outside_filter = (frame_max > (maximum-minimum)*0.1 + minimum)
-		maxima[outside_filter == 0] = 0
-		labeled, num_objects = ndi.label(maxima)
-		slices = ndi.find_objects(labeled)
-		centres = np.zeros((len(slices),2), dtype = int)
-		good_centres = 0
-		for (dy,dx) in slices:
-			centres[good_centres,0] = int((dx.start + dx.stop - 1)/2)
-			centres[good_centres,1] = int((dy.start + dy.stop - 1)/2)
-			if centres[good_centres,0] < self.neighbourhood_size/2 or \
-			   centres[good_centres,0] > (self.x_upper-self.x_lower) - \
-			   								self.neighbourhood_size/2 or \
-			   centres[good_centres,1] < self.neighbourhood_size/2 or \
-			   centres[good_centres,1] > (self.y_upper-self.y_lower) - \
-			   								self.neighbourhood_size/2:
-				good_centres -= 1
-			good_centres += 1
-		centres = centres[:good_centres]
-		return centres
+			self.show_error('Problem extracting data!')
+			return np.zeros((0,2)), np.zeros((0,2)), np.zeros((0,2))
+	
+	def show_error (self, text):
+		msg = QMessageBox()
+		msg.setIcon(QMessageBox.Critical)
+		msg.setText("Error")
+		msg.setInformativeText(text)
+		msg.setWindowTitle("Error")
+		msg.exec_()
+	
+	def plot_strip (self, strip):
+		from matplotlib import pyplot as plt
+		columns = int(np.ceil(np.sqrt(len(strip))))
+		rows = int(np.ceil(len(strip) / columns))
+		fig, axes = plt.subplots(rows, columns, squeeze = False,
+								 figsize = (3*columns, 3*rows))
+		height = self.y_upper - self.y_lower
+		width = self.x_upper - self.x_lower
+		for ax in axes.flat:
+			ax.set_axis_off()
+		for ax, (z_level, frame, dapi_centres, green_cells, red_cells) in \
+													zip(axes.flat, strip):
+			ax.imshow(frame, cmap = 'gray', extent = (0, width, height, 0))
+			other_cells = np.logical_not(green_cells | red_cells)
+			for cells, color in [(other_cells, 'white'),
+								 (green_cells, 'limegreen'),
+								 (red_cells, 'red')]:
+				ax.plot(dapi_centres[cells,0], dapi_centres[cells,1],
+						color = color, linestyle = '', marker = 'o',
+						markersize = 1.5)
+			ax.set_title('z {0:d}: {1:d} nuclei, {2:d} green, {3:d} red'.format(
+							int(z_level), dapi_centres.shape[0],
+							int(np.count_nonzero(green_cells)),
+							int(np.count_nonzero(red_cells))), fontsize = 8)
+		fig.tight_layout()
+		plt.show()
 	
 	def plot_3d (self, positions, green_cells, red_cells, epi_cells):
+		from matplotlib import pyplot as plt
+		# registers the 3d projection with older matplotlib
+		from mpl_toolkits.mplot3d import Axes3D
 		fig = plt.figure(figsize=(10,10))
 		ax = fig.add_subplot(111, projection='3d')
 		scale = 4
+		# every category is masked once, its line is switched between all
+		# of its points and a subsample while the view is being moved
+		layers = []
 		if epi_cells is not None:
 			if epi_cells.shape[0] > 0 and not self.green_active:
-				ax.plot(positions[epi_cells,0],
-						positions[epi_cells,1],
-						positions[epi_cells,2],
-						linestyle = '', marker = '.',
-						markersize = 1.5*scale, color = 'royalblue')
+				layers.append((epi_cells,
+						dict(linestyle = '', marker = '.',
+							 markersize = 1.5*scale, color = 'royalblue')))
 			if epi_cells.shape[0] > 0 and self.green_active:
-				ax.plot(positions[epi_cells & np.logical_not(green_cells),0],
-						positions[epi_cells & np.logical_not(green_cells),1],
-						positions[epi_cells & np.logical_not(green_cells),2],
-						linestyle = '', marker = '.',
-						markersize = 2.0*scale, color = 'royalblue',
-						alpha = 0.5)
-				ax.plot(positions[epi_cells & green_cells,0],
-						positions[epi_cells & green_cells,1],
-						positions[epi_cells & green_cells,2],
-						linestyle = '', marker = '.',
-						markersize = 2.0*scale, color = 'purple',
-						alpha = 0.5)
-				ax.plot(positions[np.logical_not(epi_cells) & green_cells,0],
-						positions[np.logical_not(epi_cells) & green_cells,1],
-						positions[np.logical_not(epi_cells) & green_cells,2],
-						linestyle = '', marker = '.',
-						markersize = 2.0*scale, color = 'gold',
-						alpha = 0.5)
+				layers.append((epi_cells & np.logical_not(green_cells),
+						dict(linestyle = '', marker = '.',
+							 markersize = 2.0*scale, color = 'royalblue',
+							 alpha = 0.5)))
+				layers.append((epi_cells & green_cells,
+						dict(linestyle = '', marker = '.',
+							 markersize = 2.0*scale, color = 'purple',
+							 alpha = 0.5)))
+				layers.append((np.logical_not(epi_cells) & green_cells,
+						dict(linestyle = '', marker = '.',
+							 markersize = 2.0*scale, color = 'gold',
+							 alpha = 0.5)))
 		if self.plot_dapi:
-			ax.plot(positions[:,0], positions[:,1], positions[:,2],
-					linestyle = '', marker = '.',
-					markersize = 0.8*scale, color = 'gray',
-					alpha = 0.2)
-		#if self.red_active and self.green_active:
-		#	ax.plot(positions[np.logical_and(red_cells,
-		#						np.logical_not(green_cells)),0],
-		#			positions[np.logical_and(red_cells,
-		#						np.logical_not(green_cells)),1],
-		#			positions[np.logical_and(red_cells,
-		#						np.logical_not(green_cells)),2],
-		#			linestyle = '', marker = '+',
-		#			markersize = 1.0*scale, color = 'crimson')
-		#	ax.plot(positions[np.logical_and(red_cells, green_cells),0],
-		#			positions[np.logical_and(red_cells, green_cells),1],
-		#			positions[np.logical_and(red_cells, green_cells),2],
-		#			linestyle = '', marker = '+',
-		#			markersize = 1.0*scale, color = 'purple')
-		#	ax.plot(positions[np.logical_and(green_cells,
-		#						np.logical_not(red_cells)),0],
-		#			positions[np.logical_and(green_cells,
-		#						np.logical_not(red_cells)),1],
-		#			positions[np.logical_and(green_cells,
-		#						np.logical_not(red_cells)),2],
-		#				linestyle = '', marker = 'x',
-		#			markersize = 0.8*scale, color = 'seagreen')
+			layers.append((np.ones(positions.shape[0], dtype = bool),
+						dict(linestyle = '', marker = '.',
+							 markersize = 0.8*scale, color = 'gray',
+							 alpha = 0.2)))
 		if self.red_active and self.plot_dapi:
-				ax.plot(positions[red_cells,0], positions[red_cells,1],
-								positions[red_cells,2],
-						linestyle = '', marker = '+',
-					markersize = 0.9*scale, color = 'red')
+			layers.append((red_cells,
+						dict(linestyle = '', marker = '+',
+							 markersize = 0.9*scale, color = 'red')))
 		if self.green_active and self.plot_dapi:
-				ax.plot(positions[green_cells,0], positions[green_cells,1],
-								positions[green_cells,2],
-						linestyle = '', marker = 'x',
-					markersize = 0.7*scale, color = 'seagreen')
+			layers.append((green_cells,
+						dict(linestyle = '', marker = 'x',
+							 markersize = 0.7*scale, color = 'seagreen')))
+		lines = []
+		for mask, style in layers:
+			points = positions[mask]
+			line, = ax.plot(points[:,0], points[:,1], points[:,2], **style)
+			lines.append((line, mask, points))
+		if positions.shape[0] > self.lod_points:
+			keep = voxel_subsample(positions, self.lod_points)
+			details = [ (line, points, positions[mask & keep])
+							for line, mask, points in lines ]
+			def show_detail (full):
+				for line, points, subsample in details:
+					shown = points if full else subsample
+					line.set_data_3d(shown[:,0], shown[:,1], shown[:,2])
+				fig.canvas.draw_idle()
+			fig.lod_callbacks = [
+				fig.canvas.mpl_connect('button_press_event',
+							lambda event: show_detail(False)),
+				fig.canvas.mpl_connect('button_release_event',
+							lambda event: show_detail(True)) ]
 		ax.set_xlim([ np.amin(positions[:,0]), np.amax(positions[:,0]) ])
 		ax.set_ylim([ np.amin(positions[:,1]), np.amax(positions[:,1]) ])
 		ax.set_zlim([ np.amin(positions[:,2]), np.amax(positions[:,2]) ])
@@ -1924,10 +1786,27 @@ class Window(QWidget):
 
 ################################################################################
 
+def report_startup (times):
+	times.append(('first event', time.perf_counter()))
+	previous = startup_time
+	for name, moment in times:
+		print('{0:12s} {1:7.3f} s'.format(name, moment - previous))
+		previous = moment
+	print('{0:12s} {1:7.3f} s'.format('total', previous - startup_time))
+	QApplication.instance().quit()
+
 if __name__ == "__main__":
+	profile_startup = '--profile-startup' in sys.argv
+	if profile_startup:
+		sys.argv.remove('--profile-startup')
+	times = [('imports', time.perf_counter())]
 	app = QApplication(sys.argv)
+	times.append(('application', time.perf_counter()))
 	window = Window()
+	times.append(('window', time.perf_counter()))
 	window.show()
+	if profile_startup:
+		QTimer.singleShot(0, lambda: report_startup(times))
 	sys.exit(app.exec_())
 
 ################################################################################
@@ -0,0 +1,62 @@
+#!/usr/bin/env /usr/bin/python3
+
+import sys
+import argparse
+from ND2_Pipeline import load_results, load_index, unpack_flags
+
+################################################################################
+# region queries on a saved result file #
+#########################################
+
+def query_file (file_path, query):
+	results, _, _, _, extra_arrays = load_results(file_path)
+	index = load_index(results['positions'], extra_arrays)
+	kind, first, second = query
+	distances = None
+	if kind == 'box':
+		indices = index.box(first, second)
+	elif kind == 'radius':
+		indices = index.radius(first, second)
+	else:
+		indices, distances = index.nearest(first, int(second))
+	return indices, results[indices], distances
+
+def print_rows (indices, rows, distances = None, output = sys.stdout):
+	green_cells, red_cells, epi_cells = unpack_flags(rows['flags'])
+	header = 'Index,X,Y,Z,Is_Green,Is_Red,Is_Epithellial'
+	if distances is not None:
+		header += ',Distance'
+	print(header, file = output)
+	for row, index in enumerate(indices):
+		line = '{0:d},{1:.6g},{2:.6g},{3:.6g},{4:d},{5:d},{6:d}'.format(
+					int(index), *rows['positions'][row],
+					int(green_cells[row]), int(red_cells[row]),
+					int(epi_cells[row]))
+		if distances is not None:
+			line += ',{0:.6g}'.format(distances[row])
+		print(line, file = output)
+
+################################################################################
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+				description = 'Find the nuclei of a result file in a region.')
+	parser.add_argument('results', help = 'npz file written by the pipeline')
+	group = parser.add_mutually_exclusive_group(required = True)
+	group.add_argument('--box', type = float, nargs = 6,
+					   metavar = ('X0', 'X1', 'Y0', 'Y1', 'Z0', 'Z1'))
+	group.add_argument('--radius', type = float, nargs = 4,
+					   metavar = ('X', 'Y', 'Z', 'R'))
+	group.add_argument('--nearest', type = float, nargs = 4,
+					   metavar = ('X', 'Y', 'Z', 'K'))
+	arguments = parser.parse_args()
+	if arguments.box is not None:
+		query = ('box', arguments.box[0::2], arguments.box[1::2])
+	elif arguments.radius is not None:
+		query = ('radius', arguments.radius[:3], arguments.radius[3])
+	else:
+		query = ('nearest', arguments.nearest[:3], arguments.nearest[3])
+	print_rows(*query_file(arguments.results, query))
+
+################################################################################
+# EOF
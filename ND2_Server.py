@@ -0,0 +1,350 @@
+#!/usr/bin/env /usr/bin/python3
+
+import os
+import sys
+import time
+import json
+import argparse
+import ipaddress
+import threading
+import traceback
+import urllib.request
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from ND2_Pipeline import Pipeline, load_profile
+
+################################################################################
+# state shared by all jobs of the server #
+##########################################
+
+class FrameCache ():
+	# decoded frames by (file, z), least recently used dropped first
+	def __init__ (self, max_size = 2 << 30):
+		self.max_size = max_size
+		self.size = 0
+		self.frames = OrderedDict()
+		self.lock = threading.Lock()
+	
+	def get (self, key, read):
+		with self.lock:
+			if key in self.frames:
+				self.frames.move_to_end(key)
+				return self.frames[key]
+		frames = read()
+		for frame in frames:
+			frame.flags.writeable = False
+		with self.lock:
+			if key not in self.frames:
+				self.frames[key] = frames
+				self.size += sum(frame.nbytes for frame in frames)
+			while self.size > self.max_size and len(self.frames) > 1:
+				_, dropped = self.frames.popitem(last = False)
+				self.size -= sum(frame.nbytes for frame in dropped)
+		return frames
+
+class ReaderPool ():
+	# readers stay open between jobs, one lock per file as the readers
+	# are not thread safe
+	def __init__ (self):
+		self.readers = {}
+		self.lock = threading.Lock()
+	
+	def get (self, file_path, open_reader):
+		file_path = Path(file_path).resolve()
+		signature = file_path.stat().st_mtime_ns
+		replaced = None
+		with self.lock:
+			entry = self.readers.get(file_path)
+			if entry is None or entry[0] != signature:
+				replaced = entry
+				entry = (signature, open_reader(file_path), threading.Lock())
+				self.readers[file_path] = entry
+		# the reader of the old file is closed once no job reads from it
+		if replaced is not None and hasattr(replaced[1], 'close'):
+			with replaced[2]:
+				replaced[1].close()
+		return entry
+
+class ServerPipeline (Pipeline):
+	def __init__ (self, readers, frames):
+		super().__init__()
+		self.readers = readers
+		self.frames = frames
+		self.reader_lock = threading.Lock()
+		self.reader_signature = None
+	
+	def open_reader (self, file_path):
+		self.reader_signature, reader, self.reader_lock = self.readers.get(
+					file_path, lambda path: Pipeline.open_reader(self, path))
+		return reader
+	
+	def read_frames (self, z_value):
+		def read ():
+			with self.reader_lock:
+				return Pipeline.read_frames(self, z_value)
+		return self.frames.get((str(self.nd2_file.resolve()),
+								self.reader_signature, z_value), read)
+	
+	def read_channel (self, z_value, name):
+		with self.reader_lock:
+			return Pipeline.read_channel(self, z_value, name)
+
+class JobProgress ():
+	# takes the place of the progress bar and is reported with the job
+	def __init__ (self):
+		self.minimum = 0
+		self.maximum = 0
+		self.value = 0
+		self.text = ''
+	
+	def setRange (self, minimum, maximum):
+		self.minimum = minimum
+		self.maximum = maximum
+	
+	def setMinimum (self, minimum):
+		self.minimum = minimum
+	
+	def setMaximum (self, maximum):
+		self.maximum = maximum
+	
+	def setValue (self, value):
+		self.value = value
+	
+	def setFormat (self, text):
+		self.text = text
+	
+	def reset (self):
+		self.value = self.minimum
+		self.text = ''
+	
+	def report (self):
+		return {'stage': self.text.split(':')[0], 'value': self.value,
+				'minimum': self.minimum, 'maximum': self.maximum}
+
+################################################################################
+# jobs #
+########
+
+class Job ():
+	def __init__ (self, job_id, file_path, roi = None, parameters = None,
+						profile = None):
+		self.job_id = job_id
+		self.file_path = file_path
+		self.roi = roi
+		self.parameters = parameters or {}
+		self.profile = profile
+		self.state = 'queued'
+		self.error = None
+		self.summary = None
+		self.progress = JobProgress()
+		self.submitted = time.time()
+		self.started = None
+		self.finished = None
+	
+	def report (self):
+		return {'id': self.job_id, 'file': str(self.file_path),
+				'roi': self.roi, 'profile': self.profile,
+				'state': self.state, 'error': self.error,
+				'progress': self.progress.report(),
+				'results': self.summary,
+				'submitted': self.submitted, 'started': self.started,
+				'finished': self.finished}
+
+class JobServer ():
+	def __init__ (self, workers = 1, frame_cache_size = 2 << 30,
+						max_finished = 1000):
+		self.pool = ThreadPoolExecutor(max_workers = workers)
+		self.job_workers = max(1, (os.cpu_count() or 2) // workers)
+		self.readers = ReaderPool()
+		self.frames = FrameCache(frame_cache_size)
+		self.jobs = OrderedDict()
+		self.max_finished = max_finished
+		self.lock = threading.Lock()
+		self.count = 0
+	
+	def job (self, job_id):
+		with self.lock:
+			return self.jobs.get(job_id)
+	
+	def reports (self):
+		with self.lock:
+			jobs = list(self.jobs.values())
+		return [ job.report() for job in jobs ]
+	
+	def drop_finished (self):
+		# only the latest finished jobs are kept, the oldest go first
+		finished = [ job_id for job_id, job in self.jobs.items()
+						if job.state in ('done', 'failed') ]
+		for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+			del self.jobs[job_id]
+	
+	def submit (self, request):
+		parameters = {}
+		if request.get('profile') is not None:
+			parameters.update(load_profile(request['profile']))
+		parameters.update(request.get('parameters') or {})
+		with self.lock:
+			self.count += 1
+			job = Job(str(self.count), request['file'], request.get('roi'),
+					  parameters, request.get('profile'))
+			self.jobs[job.job_id] = job
+			self.drop_finished()
+		self.pool.submit(self.run, job)
+		return job
+	
+	def run (self, job):
+		job.state = 'running'
+		job.started = time.time()
+		try:
+			pipeline = ServerPipeline(self.readers, self.frames)
+			pipeline.progress_bar = job.progress
+			pipeline.workers = self.job_workers
+			pipeline.queue_depth = 2*self.job_workers
+			pipeline.set_parameters(job.parameters)
+			pipeline.open_stack(job.file_path)
+			if job.roi is not None:
+				pipeline.x_lower, pipeline.x_upper, \
+				pipeline.y_lower, pipeline.y_upper, \
+				pipeline.z_lower, pipeline.z_upper = \
+										[ int(value) for value in job.roi ]
+			if pipeline.z_upper <= pipeline.z_lower:
+				raise ValueError('The ROI needs at least two z levels.')
+			positions, green_cells, red_cells, epi_cells = pipeline.run()
+		except Exception:
+			job.error = traceback.format_exc()
+			job.state = 'failed'
+			job.finished = time.time()
+			return
+		job.summary = {'nuclei': int(positions.shape[0]),
+					   'green': int(green_cells.sum()),
+					   'red': int(red_cells.sum()),
+					   'epithelial': int(epi_cells.sum()),
+					   'skipped_slices': int(pipeline.skipped_slices),
+					   'outputs': [ str(output)
+									for output in pipeline.output_files ]}
+		job.state = 'done'
+		job.finished = time.time()
+
+################################################################################
+# HTTP interface #
+##################
+
+class RequestHandler (BaseHTTPRequestHandler):
+	def send_json (self, data, code = 200):
+		body = json.dumps(data).encode()
+		self.send_response(code)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+	
+	def do_GET (self):
+		parts = [ part for part in self.path.split('/') if part != '' ]
+		job_server = self.server.job_server
+		job = None
+		if len(parts) == 2 and parts[0] == 'jobs':
+			job = job_server.job(parts[1])
+		if parts == ['jobs']:
+			self.send_json(job_server.reports())
+		elif job is not None:
+			self.send_json(job.report())
+		else:
+			self.send_json({'error': 'not found'}, 404)
+	
+	def do_POST (self):
+		if self.path.rstrip('/') != '/jobs':
+			self.send_json({'error': 'not found'}, 404)
+			return
+		try:
+			length = int(self.headers.get('Content-Length', 0))
+			request = json.loads(self.rfile.read(length))
+			if not Path(request['file']).is_file():
+				raise ValueError('No such file: ' + str(request['file']))
+			job = self.server.job_server.submit(request)
+		except Exception as error:
+			self.send_json({'error': str(error)}, 400)
+			return
+		self.send_json(job.report(), 202)
+
+def is_loopback (host):
+	if host == 'localhost':
+		return True
+	try:
+		return ipaddress.ip_address(host).is_loopback
+	except ValueError:
+		return False
+
+def serve (host = '127.0.0.1', port = 8702, workers = 1,
+			frame_cache_size = 2 << 30, max_finished = 1000,
+			allow_remote = False):
+	# the jobs read and write any path the server can reach and nothing
+	# checks who posts them, so other machines are only let in on request
+	if not allow_remote and not is_loopback(host):
+		raise ValueError('Refusing to listen on {0:s}, pass allow_remote '
+						 'to accept jobs from other machines.'.format(host))
+	server = ThreadingHTTPServer((host, port), RequestHandler)
+	server.job_server = JobServer(workers, frame_cache_size, max_finished)
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+
+################################################################################
+# client functions for scripts and notebooks #
+##############################################
+
+server_url = 'http://127.0.0.1:8702'
+
+def request_json (path, data = None, url = None):
+	request = urllib.request.Request((url or server_url) + path,
+				data = None if data is None else json.dumps(data).encode(),
+				headers = {'Content-Type': 'application/json'})
+	with urllib.request.urlopen(request) as response:
+		return json.loads(response.read())
+
+def submit_job (file_path, roi = None, parameters = None, profile = None,
+					url = None):
+	return request_json('/jobs', {'file': str(Path(file_path).resolve()),
+								  'roi': roi, 'parameters': parameters,
+								  'profile': profile}, url)
+
+def job_status (job_id, url = None):
+	return request_json('/jobs/' + str(job_id), url = url)
+
+def wait_for_job (job_id, interval = 1., url = None):
+	while True:
+		status = job_status(job_id, url)
+		if status['state'] in ('done', 'failed'):
+			return status
+		time.sleep(interval)
+
+################################################################################
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+				description = 'Local server that keeps the pipeline warm.')
+	parser.add_argument('--host', default = '127.0.0.1')
+	parser.add_argument('--port', type = int, default = 8702)
+	parser.add_argument('--workers', type = int, default = 1,
+						help = 'number of jobs processed at the same time')
+	parser.add_argument('--frame-cache', type = int, default = 2048,
+						help = 'size of the decoded frame cache in MiB')
+	parser.add_argument('--keep-jobs', type = int, default = 1000,
+						help = 'number of finished jobs kept for polling')
+	parser.add_argument('--allow-remote', action = 'store_true',
+						help = 'listen on a host other than the loopback')
+	arguments = parser.parse_args()
+	if not arguments.allow_remote and not is_loopback(arguments.host):
+		parser.error('--host {0:s} is reachable from other machines, '
+					 'add --allow-remote to listen on it'.format(arguments.host))
+	try:
+		serve(arguments.host, arguments.port, max(1, arguments.workers),
+			  arguments.frame_cache << 20, max(0, arguments.keep_jobs),
+			  arguments.allow_remote)
+	except KeyboardInterrupt:
+		sys.exit(0)
+
+################################################################################
+# EOF
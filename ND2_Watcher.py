@@ -0,0 +1,186 @@
+#!/usr/bin/env /usr/bin/python3
+
+import os
+import sys
+import time
+import json
+import argparse
+import traceback
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from ND2_Pipeline import (Pipeline, file_fingerprint, load_profile,
+						  partial_path)
+
+################################################################################
+# status log kept next to every ND2 file #
+##########################################
+
+def status_path (file_path):
+	return Path(file_path).with_suffix('.status.json')
+
+def read_status (file_path):
+	try:
+		with open(str(status_path(file_path)), 'r') as status_file:
+			return json.load(status_file)
+	except (OSError, ValueError):
+		return None
+
+def write_status (file_path, state, message = '', **fields):
+	status = read_status(file_path) or {'history': []}
+	status.update(fields)
+	status['state'] = state
+	status['history'].append({'time': time.strftime("%Y.%m.%d-%H.%M.%S"),
+							  'state': state,
+							  'message': message})
+	path = status_path(file_path)
+	partial = partial_path(path)
+	with open(str(partial), 'w') as status_file:
+		json.dump(status, status_file, indent = 1)
+	os.replace(str(partial), str(path))
+
+################################################################################
+# work done for one file in a worker process #
+##############################################
+
+def process_file (file_path, parameters, workers):
+	write_status(file_path, 'running', 'pid {0:d}'.format(os.getpid()))
+	try:
+		pipeline = Pipeline()
+		pipeline.set_parameters(parameters)
+		pipeline.workers = workers
+		pipeline.queue_depth = 2*workers
+		pipeline.open_stack(file_path)
+		positions, green_cells, red_cells, epi_cells = pipeline.run()
+	except Exception:
+		write_status(file_path, 'failed', traceback.format_exc())
+		return 'failed'
+	write_status(file_path, 'done',
+				 '{0:d} nuclei, {1:d} empty slices skipped'.format(
+							positions.shape[0], pipeline.skipped_slices),
+				 outputs = [ Path(output).name
+							 for output in pipeline.output_files ])
+	return 'done'
+
+################################################################################
+# folder watcher #
+##################
+
+class Watcher ():
+	def __init__ (self, folder, profile = None, workers = 1,
+						interval = 10., settle = 30., retry_failed = False):
+		self.folder = Path(folder)
+		self.profile = profile
+		if profile is None:
+			self.parameters = Pipeline().get_parameters()
+		else:
+			self.parameters = load_profile(profile)
+		self.workers = workers
+		self.file_workers = max(1, (os.cpu_count() or 2) // workers)
+		self.interval = interval
+		self.settle = settle
+		self.retry_failed = retry_failed
+		self.observed = {}
+		self.finished = set()
+		self.pending = {}
+	
+	def candidates (self):
+		return sorted( path for path in self.folder.iterdir()
+							if path.suffix.lower() == '.nd2' and \
+							   path.is_file() )
+	
+	def stable (self, path, now):
+		# a file is complete once its size and mtime stop changing
+		file_stat = path.stat()
+		signature = (file_stat.st_size, file_stat.st_mtime_ns)
+		if path not in self.observed or self.observed[path][0] != signature:
+			self.observed[path] = (signature, now)
+			return False
+		return now - self.observed[path][1] >= self.settle
+	
+	def needs_processing (self, path, fingerprint):
+		status = read_status(path)
+		if status is None or status.get('fingerprint') != fingerprint or \
+		   status.get('parameters') != self.parameters:
+			return True
+		if status['state'] == 'done':
+			return False
+		if status['state'] == 'failed':
+			return self.retry_failed
+		# queued or running without a live worker, left by an earlier run
+		return True
+	
+	def scan (self, pool):
+		now = time.time()
+		settling = 0
+		for path in self.candidates():
+			if path in self.pending:
+				continue
+			try:
+				if not self.stable(path, now):
+					settling += 1
+					continue
+				if (path, self.observed[path][0]) in self.finished:
+					continue
+				fingerprint = file_fingerprint(path)
+			except OSError:
+				continue
+			self.finished.add((path, self.observed[path][0]))
+			if not self.needs_processing(path, fingerprint):
+				continue
+			write_status(path, 'queued', profile = self.profile,
+						 fingerprint = fingerprint,
+						 parameters = self.parameters)
+			self.pending[path] = pool.submit(process_file, path,
+											 self.parameters,
+											 self.file_workers)
+		return settling
+	
+	def collect (self):
+		for path, future in list(self.pending.items()):
+			if not future.done():
+				continue
+			del self.pending[path]
+			try:
+				state = future.result()
+			except Exception:
+				write_status(path, 'failed', traceback.format_exc())
+				state = 'failed'
+			print('{0:s}: {1:s}'.format(str(path), state))
+	
+	def watch (self, once = False):
+		with ProcessPoolExecutor(max_workers = self.workers) as pool:
+			while True:
+				settling = self.scan(pool)
+				self.collect()
+				if once and settling == 0 and len(self.pending) == 0:
+					return
+				time.sleep(self.interval)
+
+################################################################################
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+				description = 'Process ND2 files as they appear in a folder.')
+	parser.add_argument('folder')
+	parser.add_argument('--profile', default = None,
+						help = 'parameter profile saved from the window')
+	parser.add_argument('--workers', type = int, default = 1,
+						help = 'number of files processed at the same time')
+	parser.add_argument('--interval', type = float, default = 10.,
+						help = 'seconds between scans of the folder')
+	parser.add_argument('--settle', type = float, default = 30.,
+						help = 'seconds a file has to stay unchanged')
+	parser.add_argument('--retry-failed', action = 'store_true')
+	parser.add_argument('--once', action = 'store_true',
+						help = 'exit once every file present is processed')
+	arguments = parser.parse_args()
+	watcher = Watcher(arguments.folder, arguments.profile,
+					  max(1, arguments.workers), arguments.interval,
+					  arguments.settle, arguments.retry_failed)
+	try:
+		watcher.watch(arguments.once)
+	except KeyboardInterrupt:
+		sys.exit(0)
+
+################################################################################
+# EOF
@@ -0,0 +1,22 @@
+import pytest
+import numpy as np
+from ND2_Pipeline import blur_frame
+
+mh = pytest.importorskip('mahotas')
+
+@pytest.mark.parametrize('dtype', [np.uint16, np.float64])
+@pytest.mark.parametrize('deviation', [1., 3.5])
+def test_low_memory_blur_matches_mahotas (dtype, deviation):
+	rng = np.random.default_rng(0)
+	frame = (rng.random((120,90)) * 4095).astype(dtype)
+	expected = mh.gaussian_filter(frame, deviation)
+	blur = blur_frame(frame, deviation, 'test_blur')
+	assert blur.dtype == np.float32
+	assert np.allclose(blur, expected, rtol = 1e-5, atol = 1e-2)
+
+def test_blur_reuses_the_named_buffer ():
+	frame = np.ones((32,32), dtype = np.uint16)
+	first = blur_frame(frame, 2., 'test_reuse')
+	second = blur_frame(frame * 2, 2., 'test_reuse')
+	assert first is second
+	assert np.allclose(second, 2.)
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+import ND2_Kernels
+from ND2_Kernels import (set_backend, get_backend, nearest_segments,
+						 link_layers, window_medians)
+
+pytest.importorskip('numba')
+
+@pytest.fixture
+def backends ():
+	# runs a function on both backends and restores the backend afterwards
+	previous = get_backend()
+	def run (function, *args):
+		results = []
+		for name in ('numpy', 'numba'):
+			set_backend(name)
+			results.append(function(*args))
+		return results
+	yield run
+	set_backend(previous)
+
+def test_nearest_segments (backends):
+	rng = np.random.default_rng(0)
+	points = rng.random((800, 2)) * 100
+	starts = rng.random((60, 2)) * 100
+	ends = starts + rng.random((60, 2)) * 10
+	# a segment of zero length
+	ends[0] = starts[0]
+	(distance_np, index_np), (distance_nb, index_nb) = \
+						backends(nearest_segments, points, starts, ends)
+	assert np.allclose(distance_np, distance_nb)
+	assert np.array_equal(index_np, index_nb)
+
+def test_link_layers (backends):
+	rng = np.random.default_rng(1)
+	layers = np.sort(rng.integers(0, 25, 4000))
+	positions_layer = np.column_stack([rng.random((4000, 2)) * 200, layers])
+	(members_np, offsets_np), (members_nb, offsets_nb) = \
+						backends(link_layers, positions_layer, 4)
+	assert np.array_equal(members_np, members_nb)
+	assert np.array_equal(offsets_np, offsets_nb)
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64, np.uint16])
+def test_window_medians (backends, dtype):
+	rng = np.random.default_rng(2)
+	image = (rng.random((256, 300)) * 4095).astype(dtype)
+	# centres near and beyond the edges of the image
+	centres = rng.integers(-5, 305, (500, 2))
+	medians_np, medians_nb = backends(window_medians, image, centres, 9)
+	assert np.allclose(medians_np, medians_nb, equal_nan = True)
+
+def test_first_use_checks_once (monkeypatch):
+	calls = []
+	monkeypatch.setattr(ND2_Kernels, 'numba_checked', False)
+	monkeypatch.setattr(ND2_Kernels, 'check_equivalence',
+						lambda: calls.append(1) or False)
+	monkeypatch.setattr(ND2_Kernels, 'backend', 'numba')
+	with pytest.warns(UserWarning):
+		assert not ND2_Kernels.use_numba()
+	assert not ND2_Kernels.use_numba()
+	assert calls == [1]
+	assert get_backend() == 'numpy'
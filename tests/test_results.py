@@ -0,0 +1,44 @@
+import numpy as np
+from ND2_Pipeline import (result_table, save_results, load_results,
+						  memmap_npz, unpack_flags)
+
+def random_table (count = 500, seed = 0):
+	rng = np.random.default_rng(seed)
+	positions = rng.random((count, 3)) * 100
+	green, red, epi = rng.random((3, count)) < 0.5
+	return result_table(positions, green, red, epi), positions, \
+		   (green, red, epi)
+
+def test_roundtrip_is_memory_mapped (tmp_path):
+	table, positions, cells = random_table()
+	file_path = tmp_path / 'results.npz'
+	save_results(file_path, table, parameters = {'green_lower': 300},
+				 scale = [0.5, 0.5, 2.], roi = [0, 9, 0, 9, 1, 5],
+				 layer_offsets = np.arange(4), layer_area = None)
+	results, parameters, scale, roi, extra_arrays = load_results(file_path)
+	assert isinstance(results, np.memmap)
+	assert np.array_equal(results['positions'], positions)
+	for loaded, saved in zip(unpack_flags(results['flags']), cells):
+		assert np.array_equal(loaded, saved)
+	assert parameters == {'green_lower': 300}
+	assert np.array_equal(scale, [0.5, 0.5, 2.])
+	assert np.array_equal(roi, [0, 9, 0, 9, 1, 5])
+	assert np.array_equal(extra_arrays['layer_offsets'], np.arange(4))
+	assert 'layer_area' not in extra_arrays
+
+def test_defaults (tmp_path):
+	table, _, _ = random_table(10)
+	save_results(tmp_path / 'results.npz', table)
+	_, parameters, scale, roi, _ = load_results(tmp_path / 'results.npz')
+	assert parameters == {}
+	assert np.array_equal(scale, np.ones(3))
+	assert np.array_equal(roi, np.zeros(6))
+
+def test_empty_and_compressed_files (tmp_path):
+	table, _, _ = random_table(0)
+	save_results(tmp_path / 'empty.npz', table)
+	assert len(load_results(tmp_path / 'empty.npz')[0]) == 0
+	values = np.arange(12.).reshape(3, 4)
+	np.savez_compressed(str(tmp_path / 'packed.npz'), values = values)
+	assert np.array_equal(memmap_npz(tmp_path / 'packed.npz', 'values'),
+						  values)
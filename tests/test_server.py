@@ -0,0 +1,16 @@
+import pytest
+from ND2_Server import is_loopback, serve
+
+@pytest.mark.parametrize('host', ['127.0.0.1', '127.0.0.2', '::1',
+								  'localhost'])
+def test_loopback_hosts (host):
+	assert is_loopback(host)
+
+@pytest.mark.parametrize('host', ['0.0.0.0', '::', '192.168.1.20',
+								  'example.org', ''])
+def test_other_hosts (host):
+	assert not is_loopback(host)
+
+def test_serve_refuses_remote_hosts ():
+	with pytest.raises(ValueError):
+		serve('0.0.0.0', 0)
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from scipy.spatial import cKDTree
+from ND2_Pipeline import SpatialIndex, load_index
+
+def clouds ():
+	rng = np.random.default_rng(0)
+	yield rng.random((3000, 3)) * np.array([400., 300., 60.])
+	# a single slice, every nucleus at the same z
+	flat = rng.random((2000, 3)) * np.array([500., 500., 0.])
+	yield flat
+	# a thin slab and a tiny sample
+	yield rng.random((2000, 3)) * np.array([800., 800., 0.5])
+	yield rng.random((3, 3)) * 10
+
+@pytest.mark.parametrize('positions', list(clouds()))
+def test_queries_match_kd_tree (positions):
+	index = SpatialIndex(positions)
+	tree = cKDTree(positions)
+	rng = np.random.default_rng(1)
+	lower = np.amin(positions, axis=0)
+	upper = np.amax(positions, axis=0)
+	span = np.maximum(upper - lower, 1.)
+	for _ in range(25):
+		# points inside and well outside the indexed region
+		point = lower + (rng.random(3) * 1.6 - 0.3) * span
+		radius = rng.random() * span.max() / 4
+		expected = np.sort(tree.query_ball_point(point, radius))
+		assert np.array_equal(index.radius(point, radius), expected)
+		corner = point + rng.random(3) * span / 3
+		inside = np.all((positions >= point) & (positions <= corner), axis=1)
+		assert np.array_equal(index.box(point, corner), np.flatnonzero(inside))
+		k = min(5, len(positions))
+		distances, _ = tree.query(point, k = k)
+		indices, found = index.nearest(point, k)
+		assert np.allclose(found, np.atleast_1d(distances))
+		assert np.allclose(np.linalg.norm(positions[indices] - point, axis=1),
+						   found)
+
+def test_flat_samples_get_a_small_grid ():
+	positions = np.random.default_rng(2).random((100, 3)) * \
+									np.array([1000., 1000., 0.])
+	index = SpatialIndex(positions)
+	assert index.shape[2] == 1
+	assert np.prod(index.shape) <= 64
+
+def test_saved_index_is_reused ():
+	positions = np.random.default_rng(3).random((500, 3)) * 50
+	index = SpatialIndex(positions)
+	loaded = load_index(positions, index.arrays())
+	assert np.array_equal(loaded.order, index.order)
+	assert np.array_equal(loaded.box([0, 0, 0], [20, 20, 20]),
+						  index.box([0, 0, 0], [20, 20, 20]))
@@ -0,0 +1,65 @@
+import numpy as np
+from scipy.spatial import Delaunay
+from ND2_Pipeline import (SimplicialComplex, chunked_triangulation,
+						  simplex_neighbours)
+
+def pruned_mesh (count = 1500, edge_max = 0.15, seed = 0):
+	rng = np.random.default_rng(seed)
+	points = rng.random((count, 3))
+	triangulation = Delaunay(points)
+	mesh = SimplicialComplex(triangulation.points, triangulation.simplices,
+							 triangulation.neighbors)
+	mesh.remove_long_simplices(edge_max)
+	return mesh
+
+def layered_cloud (count = 4000, seed = 3):
+	# nuclei sit in a few noisy z layers, which makes slivers with large
+	# circumspheres that cross the block seams
+	rng = np.random.default_rng(seed)
+	points = np.column_stack([rng.random((count, 2)),
+							  0.05 * rng.integers(0, 4, count)])
+	return points + rng.normal(0, 1e-3, points.shape)
+
+def simplex_set (simplices):
+	return set(map(tuple, np.sort(simplices, axis=1)))
+
+def test_facets_match_unique_counts ():
+	mesh = pruned_mesh()
+	facets, is_outer = mesh.facets()
+	all_facets, count = np.unique(np.sort(np.vstack(
+							[mesh.simplices[:,(0,1,2)], mesh.simplices[:,(0,1,3)],
+							 mesh.simplices[:,(0,2,3)], mesh.simplices[:,(1,2,3)]]),
+							axis=1), return_counts = True, axis=0)
+	assert simplex_set(facets) == simplex_set(all_facets)
+	assert len(facets) == len(all_facets)
+	assert simplex_set(facets[is_outer]) == simplex_set(all_facets[count == 1])
+
+def test_edges_are_unique_pairs ():
+	mesh = pruned_mesh()
+	pairs = np.unique(np.sort(np.vstack([mesh.simplices[:,[first,second]]
+								for first in range(4)
+									for second in range(first+1, 4)]),
+							  axis=1), axis=0)
+	assert np.array_equal(mesh.edges(), pairs)
+
+def test_simplex_neighbours_match_qhull ():
+	rng = np.random.default_rng(1)
+	triangulation = Delaunay(rng.random((500, 3)))
+	neighbours = simplex_neighbours(triangulation.simplices)
+	assert np.array_equal(neighbours, triangulation.neighbors)
+
+def test_chunked_triangulation_matches_delaunay ():
+	edge_max = 0.1
+	points = layered_cloud()
+	triangulation = Delaunay(points)
+	whole = SimplicialComplex(points, triangulation.simplices)
+	expected = triangulation.simplices[whole.longest_edges <= edge_max]
+	chunked = chunked_triangulation(points, edge_max, block_points = 300)
+	assert simplex_set(chunked.simplices) == simplex_set(expected)
+	assert len(chunked.simplices) == len(expected)
+
+def test_chunked_triangulation_keeps_small_blocks ():
+	points = np.array([[0., 0., 0.], [1., 0., 0.], [0., 1., 0.],
+					   [0., 0., 1.]])
+	mesh = chunked_triangulation(points, 2., block_points = 1)
+	assert simplex_set(mesh.simplices) == {(0, 1, 2, 3)}